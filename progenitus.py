@@ -19,7 +19,7 @@ import xml.etree.ElementTree # py2exe fix
 # Import everything explicitly
 from progenitus import async, config, settings, lang, uiloader
 from progenitus.client import desktop, muc, network, players
-from progenitus.db import cards, pics, semantics
+from progenitus.db import cards, memory, packs, pics, semantics
 from progenitus.editor import decks
 from progenitus.miner import magiccardsinfo, miner, tcgplayercom
 from progenitus.client import gui as clientgui
@@ -67,6 +67,12 @@ optparser.add_option("--logfile", action="store", dest="logfile",
 	default=config.LOG_FILE, help=_("External file to write the log to"))
 optparser.add_option("--settings", action="store", dest="settings_file",
 	default=config.SETTINGS_FILE, help=_("Settings file"))
+optparser.add_option("--memory-report", action="store_true",
+	dest="memory_report", default=False,
+	help=_("print the memory used by the caches when the program exits"))
+optparser.add_option("--pack-pictures", action="store_true",
+	dest="pack_pictures", default=False,
+	help=_("move the downloaded card pictures into one archive per set"))
 optparser.set_defaults(run="editor") # by default run the editor
 
 
@@ -98,6 +104,15 @@ if warn_about_invalid_level:
 	logging.warning("'%s' is not a valid logging level.", options.log_level)
 
 
+# Convert the picture cache
+if options.pack_pictures:
+	num = packs.pack_all()
+	settings.packed_pictures = True # keep new pictures packed, too
+	settings.save()
+	print _("Packed the pictures of %d sets.") % num
+	sys.exit()
+
+
 # Run the program
 if options.run == "editor":
 	iface = editorgui.Interface()
@@ -115,6 +130,11 @@ elif options.run == "updater":
 else:
 	assert(False) # Should specify either editor, client or updater to run
 
+if options.memory_report:
+	report = memory.format_report()
+	logging.info(_("Memory report:\n%s"), report)
+	print report
+
 
 # Disable the logger
 logging.shutdown()
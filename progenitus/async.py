@@ -137,6 +137,8 @@ def run(generator):
 	try:
 		while True:
 			result = generator.send(result)
+			if isinstance(result, _ThreadInit):
+				result = result.func() # no need for a thread here
 	except StopIteration:
 		pass
 	finally:
@@ -275,10 +275,7 @@ class CairoDesktop(gtk.DrawingArea):
 			cr.rectangle(x, y, card_width, card_height)
 			cr.translate(x, y)
 			cr.clip()
-			surface = self.picfactory.get(card.id, card_width)
-			assert isinstance(surface, cairo.Surface)
-			cr.set_source_surface(surface)
-			cr.paint()
+			self.picfactory.paint(cr, card.id, card_width, self.repaint_hand)
 			cr.restore()
 			x += card_width + spacing
 	
@@ -311,11 +308,19 @@ class CairoDesktop(gtk.DrawingArea):
 				self.enlarged_card_last_pos = None
 		else:
 			self.repaint_enlarged_card()
-			cardpic = pics.surface_from_pixbuf(pics.get(cardid))[0]
-			self.enlarged_card = cardpic, flipped
+			pixbuf = pics.request(cardid, self._enlarged_card_decoded)
+			if pixbuf is None:
+				pixbuf = pics.placeholder() # until the picture is decoded
+			cardpic = pics.surface_from_pixbuf(pixbuf)[0]
+			self.enlarged_card = cardpic, flipped, cardid
 			self.enlarged_card_last_pos = self._get_enlarged_card_pos()
 			self.repaint_enlarged_card()
 	
+	def _enlarged_card_decoded(self, cardid):
+		"""Show the picture of the enlarged card once it has been decoded"""
+		if self.enlarged_card is not None and self.enlarged_card[2] == cardid:
+			self.show_enlarged_card(cardid, self.enlarged_card[1])
+	
 	def _paint_enlarged_card(self, cr, width, height):
 		if self.enlarged_card is not None:
 			cr.translate(*self._get_enlarged_card_pos())
@@ -350,7 +355,8 @@ class CairoDesktop(gtk.DrawingArea):
 		cr.rectangle(0, 0, width, height_)
 		cr.clip()
 		
-		# Paint items
+		# Paint items; the pictures on screen are kept in the picture cache
+		self.picfactory.drawn.clear()
 		for item in self._items:
 			if item.visible:
 				cr.save()
@@ -364,6 +370,7 @@ class CairoDesktop(gtk.DrawingArea):
 		# Paint hand and enlarged cards
 		self._paint_hand(cr, width, height)
 		self._paint_enlarged_card(cr, width, height_)
+		pics.pin(self, self.picfactory.drawn)
 	
 	
 	# Mouse input
@@ -705,7 +712,7 @@ class CardItem(Item):
 	dragable = True
 	
 	def __init__(self, cardortoken, owner, mine=False):
-		if isinstance(cardortoken, cards.Card):
+		if isinstance(cardortoken, cards.CardBase):
 			self.card = cardortoken
 		elif isinstance(cardortoken, cards.Token):
 			self.token = cardortoken
@@ -731,8 +738,10 @@ class CardItem(Item):
 				cardid = "deckmaster"
 		width = int(math.ceil((self.h if self.tapped else self.w)
 			* desktop.zoom))
-		surface = desktop.picfactory.get(cardid, width)
+		surface = desktop.picfactory.get(cardid, width, self.repaint)
 		assert(isinstance(surface, cairo.Surface))
+		zoom = float(width) / surface.get_width()
+		cr.scale(zoom, zoom) # the surface can be a few pixels wider
 		
 		# rotate image
 		phi = math.pi / 2 if self.tapped else 0
@@ -875,10 +884,7 @@ class Library(Item):
 	def paint(self, desktop, cr):
 		if len(self.parent.player.library) > 0:
 			width = int(math.ceil(self.w * desktop.zoom))
-			surface = desktop.picfactory.get("deckmaster", width)
-			assert(isinstance(surface, cairo.Surface))
-			cr.set_source_surface(surface)
-			cr.paint()
+			desktop.picfactory.paint(cr, "deckmaster", width)
 
 
 class Graveyard(Item):
@@ -890,10 +896,7 @@ class Graveyard(Item):
 		if len(self.parent.player.graveyard) > 0:
 			card = self.parent.player.graveyard[-1]
 			width = int(math.ceil(self.w * desktop.zoom))
-			surface = desktop.picfactory.get(card.id, width)
-			assert(isinstance(surface, cairo.Surface))
-			cr.set_source_surface(surface)
-			cr.paint()
+			desktop.picfactory.paint(cr, card.id, width, self.repaint)
 
 
 
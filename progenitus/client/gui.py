@@ -45,7 +45,7 @@ class Interface(uiloader.Interface):
 		self.load(config.GTKBUILDER_CLIENT)
 		self.main_win.set_title(config.APP_NAME_CLIENT)
 		self.main_win.maximize()
-		glib.idle_add(cards.connect)
+		glib.idle_add(cards.connect, True) # load the cards incrementally
 		self.label_version.set_text(config.VERSION)
 		
 		# Insert a CairoDesktop
@@ -110,22 +110,30 @@ class Interface(uiloader.Interface):
 		"""Load the tokens into the autocompleting combobox"""
 		cards.load_tokens()
 		for token in cards.tokens:
-			if token.power != "":
-				desc = "%s %s/%s (%s)" % (token.subtype, token.power,
-					token.toughness, token.setname)
-			else:
-				desc = "%s (%s)" % (token.subtype, token.setname)
-			self.liststore_tokens.append((token.id, desc, token.setname,
-				token.releasedate))
+			self.liststore_tokens.append((token.id, _token_description(token),
+				token.setname, token.releasedate))
 		
-		# Complete the entry_tokens widget
+		# Complete the entry_tokens widget; the suggestions are looked up in
+		# the token index instead of letting gtk filter all tokens
+		self._token_completions = gtk.ListStore(str, str) # id, description
 		completion = gtk.EntryCompletion()
-		completion.set_model(self.liststore_tokens)
+		completion.set_model(self._token_completions)
 		completion.set_text_column(1)
-		completion.set_inline_completion(True)
+		completion.set_match_func(lambda completion, key, it: True)
 		completion.set_minimum_key_length(2)
 		completion.connect("match-selected", self.token_autocomplete_pick)
 		self.entry_tokens.set_completion(completion)
+		self.entry_tokens.connect("changed", self.update_token_completions)
+	
+	def update_token_completions(self, widget):
+		"""Look up the tokens matching the entered text"""
+		self._token_completions.clear()
+		text = self.entry_tokens.get_text()
+		if len(text) < 2:
+			return
+		for token in cards.get_token_index().search(text, 30):
+			self._token_completions.append((token.id,
+				_token_description(token)))
 	
 	def init_counters_autocomplete(self):
 		completion = gtk.EntryCompletion()
@@ -691,12 +699,16 @@ class Interface(uiloader.Interface):
 	
 	def tokens_activate(self, widget):
 		text = self.entry_tokens.get_text()
-		for row in self.liststore_tokens:
-			if text == row[1]:
-				self.selected_token(row[0])
+		l = cards.get_token_index().search(text)
+		for token in l:
+			if text == _token_description(token):
+				self.selected_token(token.id)
 				break
 		else:
-			logging.info(_("Token '%s' is invalid."), text)
+			if l != []:
+				self.selected_token(l[0].id) # the best match
+			else:
+				logging.info(_("Token '%s' is invalid."), text)
 	
 	def selected_token(self, tokenid):
 		self.entrybar_unfocus()
@@ -945,7 +957,7 @@ class Interface(uiloader.Interface):
 		"""The user hovers the mouse over an item or handcard"""
 		if isinstance(item, desktop.CardItem):
 			self.status_label.set_text(item.get_description())
-		if isinstance(item, cards.Card):
+		if isinstance(item, cards.CardBase):
 			self.status_label.set_text(item.name)
 		if isinstance(item, desktop.Graveyard):
 			graveyard = item.parent.player.graveyard
@@ -1003,7 +1015,7 @@ class Interface(uiloader.Interface):
 			self.menuitem_graveyard_shuffle_lib.set_visible(item.mine)
 			self.menu_graveyard.popup(None, None, None, event.button,
 				event.time)
-		if isinstance(item, cards.Card):
+		if isinstance(item, cards.CardBase):
 			self.menu_hand.popup(None, None, None, event.button, event.time)
 	
 	
@@ -1174,3 +1186,13 @@ class Interface(uiloader.Interface):
 		y = random.random() * (h - 3.5) / 2
 		self.my_player.move_card(cards.get(cardid), None,
 			self.my_player.battlefield, x, y)
+
+
+# Helper functions
+
+def _token_description(token):
+	"""Get the text a token is listed with in the token chooser"""
+	if token.power != "":
+		return "%s %s/%s (%s)" % (token.subtype, token.power, token.toughness,
+			token.setname)
+	return "%s (%s)" % (token.subtype, token.setname)
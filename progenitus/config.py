@@ -48,7 +48,12 @@ def CARD_PICS_PATH(cid):
 		setname += "_"  # BEWARE: DIRTY HACK!
 	return("cards/%s/%s.jpg" % (setname, cid))
 TOKEN_PICS_PATH = lambda tid: ("tokens/%s.jpg" % tid)
+PICS_PACK_PATH = lambda cid: ("packs/%s.pack" % # named like the set folder
+	CARD_PICS_PATH(cid).split("/")[1])
+THUMBNAILS_PATH = lambda width, path: ("thumbnails/%d/%s" % (width, path))
+THUMBNAIL_WIDTHS = (64, 128, 256) # pre-scaled picture sizes, ascending
 DB_FILE = "mtg.sqlite"
+DB_SNAPSHOT_FILE = "mtg.snapshot" # pre-built in-memory card data
 DECKMASTER_PATH = "media/deckmaster.png"
 DEFAULT_DECKS_PATH = "default decks"
 
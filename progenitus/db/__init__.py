@@ -1,2 +1,3 @@
 
-__all__ = ["cards", "pics", "semantics"]
+__all__ = ["cards", "filters", "memory", "migrations", "names", "packs",
+	"pics", "semantics"]
@@ -3,6 +3,15 @@
 
 import datetime
 import os
+import sys
+import re
+import struct
+import time
+import array
+import bisect
+import cPickle
+import threading
+import collections
 import glib
 import sqlite3
 from gettext import gettext as _
@@ -10,45 +19,378 @@ import logging
 
 from progenitus import config
 from progenitus import settings
+import migrations
 
 #
 # Every card has a unique id string; tokens and cards have different ids.
 # Use the function cards.is_token(cardid) to tell them apart.
 #
 
-_cursor = None # The database cursor
-_last_search = None # The last query executed
+_db_file = None # Path to the database file
+_local = threading.local() # Holds the connection of every thread
+_writer = None # The connection used for writing
+_replica = None # Keeps the in-memory copy of the database alive
+_replica_uri = None # Uri of the in-memory copy, if it is used
+_replicas = 0 # Number of in-memory copies created so far
+_connections = 0 # Changes whenever the read-only connections must be reopened
 tokens = None # A list of all tokens
-cards = None # A list of all cards
+cards = None # A sequence of all cards
 sets = None # A list of all card sets
-_by_id = None # A dict mapping id to card or token instance
-_by_name = None # A dict mapping a name to a list of card instances
+_store = None # The CardStore holding all cards
+_by_id = None # A dict mapping id to card index or token instance
+_by_name = None # A dict mapping a name to a list of card indices
+_min_prices = None # A dict mapping a name to the cheapest price
+_token_index = None # The TokenIndex of the tokens
+_fulltext = False # Whether the full-text index can be used
 
+# Events that are set as soon as the tokens, the sets and the cards are loaded
+stages = ("tokens", "sets", "cards")
+_loaded = dict((stage, threading.Event()) for stage in stages)
 
-def connect():
-	"""Establish database connection"""
-	db_file = os.path.join(settings.cache_dir, config.DB_FILE)
-	assert(os.path.isfile(db_file))
-	global sqlconn, _cursor
-	sqlconn = sqlite3.connect(db_file)
-	_cursor = sqlconn.cursor()
+# The card attributes in the order of the database columns
+_card_attributes = ("id", "name", "setid", "setname", "manacost",
+	"converted_cost", "iswhite", "isblue", "isblack", "isred", "isgreen",
+	"iscolorless", "cardtype", "subtype", "text", "flavor", "artist", "rarity",
+	"power", "toughness", "price", "releasedate", "collectorsid", "linkedto",
+	"mana_white", "mana_blue", "mana_black", "mana_red", "mana_green",
+	"mana_generic", "mana_x", "mana_hybrid", "mana_phyrexian", "colors",
+	"identity", "power_value", "power_variable", "toughness_value",
+	"toughness_variable")
+
+# The database columns of the card attributes
+_card_columns = tuple({"converted_cost": "converted", "cardtype": "type"}
+	.get(attr, attr) for attr in _card_attributes)
+_card_column_list = ", ".join('"%s"' % col for col in _card_columns)
+
+# A card with no attributes set
+_card_defaults = ("", "", "", "", "", 0, 0, 0, 0, 0, 0, 0, "", "", "", "", "",
+	"", "", "", -1, 0, "", 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, 0, None, 0, None, 0)
+
+
+# Version of the snapshot file format; increase on every incompatible change
+_SNAPSHOT_VERSION = 3
+
+# Pragmas of the read-only connections to the database file in the in-memory
+# mode, in case the copy could not be made; memory mapped io and a larger page
+# cache (negative sizes are in KB)
+_disk_pragmas = ("PRAGMA mmap_size = %d" % (256 * 1024 * 1024),
+	"PRAGMA cache_size = %d" % -(16 * 1024))
+
+# Ranking weights for the columns of the full-text index
+_fts_weights = (10., 4., 4., 1., .5, .5)
+_re_fts_word = re.compile(r'\w+', re.UNICODE)
+
+
+def connect(incremental=False, callback=None):
+	"""Establish database connection and load the card data; in the
+	incremental mode the cards are loaded by a worker thread after this
+	returns. callback(stage) is called in the main loop for every loaded
+	stage."""
+	global _db_file, _by_id, _by_name, _min_prices, _fulltext
+	_db_file = os.path.join(settings.cache_dir, config.DB_FILE)
+	assert(os.path.isfile(_db_file))
+	for event in _loaded.values():
+		event.clear()
+	conn = _open_connection()
+	migrations.upgrade(conn)
+	c = conn.cursor()
+	_fulltext = migrations.has_table(c, "cards_fts") and \
+		migrations.has_fulltext_support(c)
+	conn.close()
+	_reopen_connections() # might be connected to an outdated copy
+	if settings.db_in_memory:
+		_create_replica()
+	if not incremental and not settings.save_ram and load_snapshot():
+		# Everything has been loaded from the snapshot
+		for stage in stages:
+			_set_loaded(stage, callback)
+		return
 	load_tokens()
+	_set_loaded("tokens", callback)
 	load_sets()
-	if not settings.save_ram:
+	_set_loaded("sets", callback)
+	if settings.save_ram:
+		_set_loaded("cards", callback) # cards are not held in memory
+	elif incremental:
+		# Lookups of cards that have not been loaded yet wait for the worker
+		_by_id = dict((token.id, token) for token in tokens)
+		_by_name = dict()
+		_min_prices = dict()
+		thread = threading.Thread(target=_load_incrementally,
+			args=(callback,))
+		thread.daemon = True
+		thread.start()
+	else:
 		load_cards()
 		build_datastructures()
+		save_snapshot()
+		_set_loaded("cards", callback)
+
+
+def _load_incrementally(callback):
+	"""Load the cards in chunks; runs in a worker thread"""
+	try:
+		if not load_snapshot():
+			load_cards(lambda num: _index_cards(len(_store) - num))
+			save_snapshot()
+	finally:
+		_set_loaded("cards", callback)
+
+
+def _set_loaded(stage, callback):
+	"""Signal that a stage has been loaded"""
+	_loaded[stage].set()
+	if callback is not None:
+		glib.idle_add(callback, stage)
+
+
+def is_loaded(stage):
+	"""Check if the tokens, sets or cards have been loaded"""
+	return _loaded[stage].is_set()
+
+
+def wait_loaded(stage):
+	"""Block until the tokens, sets or cards have been loaded"""
+	# Event.wait without timeout cannot be interrupted by KeyboardInterrupt
+	while not _loaded[stage].wait(1):
+		pass
+
+
+#
+# Sqlite connections must not be shared between threads. Every thread gets its
+# own read-only connection on first use, so searches running in background
+# tasks neither serialize nor disturb each other. The updater writes through
+# the separate writer connection. The database uses a write-ahead log, so
+# readers and the writer do not block each other.
+#
+
+#
+# In the in-memory mode (settings.db_in_memory) the database file is copied
+# into a shared in-memory database on connect, and the read-only connections
+# are opened on the copy. This makes queries fast in the reduced RAM mode,
+# where every lookup goes to the database, at the cost of holding the database
+# file in memory, which is still a lot less than the card instances.
+# The copy is not updated; once the writer connection is used, the read-only
+# connections of all threads are reopened on the file.
+#
+
+def _open_connection(readonly=False, check_same_thread=True):
+	"""Open a new connection to the database file or its in-memory copy"""
+	assert(_db_file is not None) # must be connected
+	if readonly and _replica_uri is not None:
+		conn = sqlite3.connect(_replica_uri,
+			check_same_thread=check_same_thread)
+	else:
+		conn = sqlite3.connect(_db_file, check_same_thread=check_same_thread)
+	conn.create_function("fts_rank", 1, _fts_rank)
+	if readonly:
+		conn.execute('PRAGMA query_only = ON')
+		if settings.db_in_memory and _replica_uri is None:
+			for pragma in _disk_pragmas:
+				conn.execute(pragma)
+	else:
+		conn.execute('PRAGMA journal_mode = WAL')
+	return conn
+
+
+def get_connection():
+	"""Get the calling thread's read-only database connection"""
+	conn = getattr(_local, "conn", None)
+	if conn is None or _local.connections != _connections:
+		if conn is not None:
+			conn.close() # connected to a copy that is no longer used
+		conn = _local.conn = _open_connection(readonly=True)
+		_local.connections = _connections
+	return conn
+
+
+def _reopen_connections():
+	"""Make every thread open a new read-only connection on its next
+	database access"""
+	global _connections
+	_connections += 1
+
+
+def writer():
+	"""Get the database connection for writing"""
+	global _writer
+	if _writer is None:
+		_drop_replica() # the copy would get outdated
+		# The updater uses it from its worker thread
+		_writer = _open_connection(check_same_thread=False)
+	return _writer
+
+
+def _create_replica():
+	"""Copy the database file into a shared in-memory database"""
+	global _replica, _replica_uri, _replicas
+	_drop_replica()
+	_replicas += 1
+	uri = "file:progenitus-%d-%d?mode=memory&cache=shared" % (os.getpid(),
+		_replicas)
+	try:
+		replica = sqlite3.connect(uri, check_same_thread=False)
+	except sqlite3.Error as e:
+		logging.warning(_("Could not copy the card database into memory: %s"),
+			e)
+		return
+	if replica.execute('PRAGMA database_list').fetchone()[2] != "":
+		# This sqlite version does not support uri filenames and has created
+		# a file of that name instead
+		replica.close()
+		if os.path.isfile(uri):
+			os.remove(uri)
+		logging.warning(_("Could not copy the card database into memory: "
+			"uri filenames are not supported"))
+		return
+	start = datetime.datetime.now()
+	if hasattr(replica, "backup"):
+		disk = sqlite3.connect(_db_file)
+		disk.backup(replica)
+		disk.close()
+	else:
+		_copy_database(replica)
+	logging.info(_("Copied the card database into memory in %s"),
+		datetime.datetime.now() - start)
+	_replica, _replica_uri = replica, uri
+	_reopen_connections()
+
+
+def _copy_database(replica):
+	"""Copy the database file table by table; for sqlite3 modules without the
+	backup api"""
+	c = replica.cursor()
+	c.execute('ATTACH DATABASE ? AS "disk"', (_db_file,))
+	c.execute('SELECT "type", "name", "sql" FROM "disk"."sqlite_master" '
+		'WHERE "sql" IS NOT NULL')
+	schema = c.fetchall()
+	for type_, name, sql in schema:
+		# Skip the tables of sqlite and the full-text index; the full-text
+		# index is rebuilt instead, triggers are not needed for reading
+		if type_ != "table" or name.startswith(("sqlite_", "cards_fts_")):
+			continue
+		c.execute(sql)
+		if not sql.upper().startswith("CREATE VIRTUAL TABLE"):
+			c.execute('INSERT INTO "main"."%s" SELECT * FROM "disk"."%s"'
+				% (name, name))
+	for type_, name, sql in schema:
+		if type_ == "index":
+			c.execute(sql)
+	if any(name == "cards_fts" for type_, name, sql in schema):
+		c.execute('INSERT INTO "cards_fts" ("cards_fts") VALUES (\'rebuild\')')
+	c.execute('ANALYZE')
+	replica.commit()
+	c.execute('DETACH DATABASE "disk"')
+
+
+def _drop_replica():
+	"""Stop using the in-memory copy for new connections"""
+	global _replica, _replica_uri
+	if _replica is not None:
+		# The memory is freed when the last connection to the copy is closed
+		_replica.close()
+		_reopen_connections() # other threads would keep reading the copy
+	_replica = _replica_uri = None
+
+
+#
+# Mana costs are written like "2WW", "X{R}" or "{W/U}{W/U}". The colored
+# symbols of hybrid costs like {W/U} or {2/W} count towards all their colors,
+# phyrexian symbols like {G/P} towards their color.
+#
+
+ManaCost = collections.namedtuple("ManaCost", ("white", "blue", "black",
+	"red", "green", "generic", "x", "hybrid", "phyrexian", "converted"))
+
+_re_mana_symbol = re.compile(r'\{([^}]*)\}|(\d+)|([^{}/])')
+_mana_colors = ("W", "U", "B", "R", "G")
+
+
+def parse_mana(manacost):
+	"""Parse a mana cost into a ManaCost tuple"""
+	pips = [0, 0, 0, 0, 0]
+	generic = x = hybrid = phyrexian = converted = 0
+	for braced, number, symbol in _re_mana_symbol.findall(manacost or ""):
+		if number != "":
+			generic += int(number)
+			converted += int(number)
+			continue
+		parts = (symbol or braced).upper().split("/")
+		if len(parts) > 1 and "P" in parts:
+			phyrexian += 1
+			parts.remove("P")
+		elif len(parts) > 1:
+			hybrid += 1
+		cost = 0 # a hybrid symbol costs as much as its most expensive part
+		for part in parts:
+			if part in _mana_colors:
+				pips[_mana_colors.index(part)] += 1
+				cost = max(cost, 1)
+			elif part.isdigit():
+				cost = max(cost, int(part))
+				if len(parts) == 1:
+					generic += int(part)
+			elif part in ("X", "Y", "Z"):
+				x += 1
+			elif part == "P":
+				phyrexian += 1
+				cost = max(cost, 1)
+		converted += cost
+	return ManaCost(*(pips + [generic, x, hybrid, phyrexian, converted]))
 
 
 def convert_mana(manacost):
-	if manacost is None:
-		return 0
-	cc = manacost
-	for z in "WUBRGXYZP{/}":
-		cc = cc.replace(z, "")
-	cc = "0" if cc == "" else cc
-	return sum(map(lambda s: manacost.count(s), "WUBRGP")) + int(cc) - \
-		manacost.count("}")
-			# alternative colors e.g. {W/G} have 1 less than counted
+	"""Get the converted mana cost"""
+	return parse_mana(manacost).converted
+
+
+#
+# The colors of a card are stored as a bitmask as well: the five colors are
+# the bits 0 to 4 in the order of _mana_colors, colorless is bit 5. The color
+# identity additionally contains the colors of the mana symbols in the rules
+# text; it never contains the colorless bit.
+#
+
+color_bits = {"white": 1, "blue": 2, "black": 4, "red": 8, "green": 16,
+	"colorless": 32}
+ALL_COLORS = 31 # the bits of the five colors
+
+_re_braced_symbol = re.compile(r'\{([^}]*)\}')
+
+
+def color_mask(colors):
+	"""Get the bitmask of a list of color names"""
+	return sum(color_bits[c] for c in set(colors))
+
+
+def identity_mask(colors, text):
+	"""Get the color identity from the color mask and a text containing mana
+	symbols"""
+	identity = colors & ALL_COLORS
+	for symbol in _re_braced_symbol.findall(text or ""):
+		for part in symbol.upper().split("/"):
+			if part in _mana_colors:
+				identity |= 1 << _mana_colors.index(part)
+	return identity
+
+
+#
+# Power and toughness are stored as the printed text and as a number. Values
+# like "*", "1+*" or "X" are variable; their number is the fixed part. Cards
+# without power or toughness have no number (NULL).
+#
+
+_re_stat_number = re.compile(r'\s*([+-]?\d+)')
+_re_stat_variable = re.compile(r'[*XY?]')
+
+
+def parse_stat(stat):
+	"""Get the number of a power or toughness and whether it is variable"""
+	if stat is None or stat.strip() == "":
+		return None, False
+	match = _re_stat_number.match(stat)
+	value = 0 if match is None else int(match.group(1))
+	return value, _re_stat_variable.search(stat) is not None
 
 
 def is_token(cardid):
@@ -56,19 +398,11 @@ def is_token(cardid):
 	return cardid.find('.T.') >= 0
 
 
-class Card(object):
-	"""Magic card instance"""
+class CardBase(object):
+	"""Behaviour shared by Card and CardView; use isinstance(obj, CardBase) to
+	check for either"""
 	
-	def __init__(self, *args):
-		if len(args) == 0:
-			args = ("", "", "", "", "", 0, 0, 0, 0, 0, 0, 0, "", "", "", "", "",
-				"", "", "", -1, 0, "", 0)
-		(self.id, self.name, self.setid, self.setname, self.manacost,
-			self.converted_cost, self.iswhite, self.isblue, self.isblack,
-			self.isred, self.isgreen, self.iscolorless, self.cardtype,
-			self.subtype, self.text, self.flavor, self.artist,
-			self.rarity, self.power, self.toughness, self.price,
-			self.releasedate, self.collectorsid, self.linkedto) = args
+	__slots__ = ()
 	
 	def __eq__(self, other):
 		return self.id == other.id
@@ -81,20 +415,38 @@ class Card(object):
 		self.id = "%s.%s" % (self.setid, self.collectorsid)
 	
 	def derive_colors(self):
-		"""Derive this card's color"""
+		"""Derive this card's color, color bitmask and color identity"""
 		for c in ("white", "blue", "black", "red", "green", "colorless"):
 			setattr(self, "is" + c, False)
 		for c in ("white", "blue", "black", "red", "green", "colorless"):
 			if self.text.find("%s is %s." % (self.name, c)) >= 0:
 				setattr(self, "is" + c, True)
-				return
-		iscolorless = True
-		for c, z in (("white", "W"), ("blue", "U"), ("black", "B"),
-			("red", "R"), ("green", "G")):
-			setattr(self, "is" + c, z in self.manacost)
-			iscolorless = iscolorless and not z in self.manacost
-		self.iscolorless = False if self.cardtype.find("Land") >= 0 else \
-			iscolorless # Lands do not count as colorless
+				break
+		else:
+			iscolorless = True
+			for c, z in (("white", "W"), ("blue", "U"), ("black", "B"),
+				("red", "R"), ("green", "G")):
+				setattr(self, "is" + c, z in self.manacost)
+				iscolorless = iscolorless and not z in self.manacost
+			self.iscolorless = False if self.cardtype.find("Land") >= 0 else \
+				iscolorless # Lands do not count as colorless
+		self.colors = color_mask(c for c in color_bits
+			if getattr(self, "is" + c))
+		self.identity = identity_mask(self.colors, self.manacost + " " +
+			self.text)
+	
+	def derive_mana(self):
+		"""Derive the converted cost and the mana symbol counts"""
+		(self.mana_white, self.mana_blue, self.mana_black, self.mana_red,
+			self.mana_green, self.mana_generic, self.mana_x, self.mana_hybrid,
+			self.mana_phyrexian, self.converted_cost) = \
+				parse_mana(self.manacost)
+	
+	def derive_stats(self):
+		"""Derive the numbers of power and toughness"""
+		self.power_value, self.power_variable = parse_stat(self.power)
+		self.toughness_value, self.toughness_variable = \
+			parse_stat(self.toughness)
 	
 	def markup(self):
 		"""Return the card details as a gtk markup text"""
@@ -121,13 +473,7 @@ class Card(object):
 		"""Get the pricing of a card with the same name"""
 		if self.price >= 0:
 			return self.price
-		# search for a card with the same name and pricing information
-		query = '"name" = ? AND "price" >= 0 ORDER BY "price" ASC'
-		l = search(query, (self.name,), 1)
-		if len(l) >= 1:
-			return l[0].price
-		else:
-			return None
+		return get_min_prices((self.name,)).get(self.name)
 	
 	def get_composed_type(self):
 		if self.subtype == "":
@@ -137,18 +483,30 @@ class Card(object):
 	
 	def as_tuple(self):
 		"""Return the magic card as a tuple"""
-		return (self.id, self.name, self.setid, self.setname, self.manacost,
-			self.converted_cost, self.iswhite, self.isblue, self.isblack,
-			self.isred, self.isgreen, self.iscolorless, self.cardtype,
-			self.subtype, self.text, self.flavor, self.artist, self.rarity,
-			self.power, self.toughness, self.price, self.releasedate,
-			self.collectorsid, self.linkedto)
+		return tuple(getattr(self, attr) for attr in _card_attributes)
 
 
+class Card(CardBase):
+	"""Magic card instance"""
+	
+	__slots__ = _card_attributes
+	
+	def __init__(self, *args):
+		if len(args) == 0:
+			args = _card_defaults
+		assert(len(args) == len(_card_attributes))
+		for attr, value in zip(_card_attributes, args):
+			setattr(self, attr, value)
+
 
 class Token(object):
 	"""A token instance"""
 	
+	__slots__ = ("id", "setid", "setname", "iswhite", "isblue", "isblack",
+		"isred", "isgreen", "iscolorless", "cardtype", "subtype", "text",
+		"flavor", "artist", "power", "toughness", "releasedate",
+		"collectorsid")
+	
 	def __init__(self, *args):
 		if args == ():
 			args = ("", "", "", 0, 0, 0, 0, 0, 0, "", "", "", "", "", "", "",
@@ -199,12 +557,276 @@ class Token(object):
 			self.power, self.toughness, self.releasedate, self.collectorsid)
 
 
+#
+# The TokenIndex finds tokens by the words of their description while the user
+# types, e.g. "2/2 zom" or "white sol". Every token is indexed under the words
+# of its subtype, its power/toughness, its color names and the words of its set
+# name, all in lower case; every word of a query has to be the beginning of one
+# of these terms, so the description the token chooser lists a token with,
+# e.g. "Zombie 2/2 (Magic 2010)", finds the token. The terms are kept sorted,
+# so the terms starting with a word are found by bisection.
+#
+
+_re_token_term = re.compile(r'[^\s,()]+', re.UNICODE)
+
+
+class TokenIndex(object):
+	"""Index of tokens by subtype, power/toughness, color and set"""
+	
+	def __init__(self, tokenlist):
+		self.tokens = tokenlist
+		self._by_key = dict() # (subtype, power, toughness) to tokens
+		postings = dict() # term to token indices
+		for i, token in enumerate(tokenlist):
+			key = self.key(token.subtype, token.power, token.toughness)
+			self._by_key.setdefault(key, []).append(token)
+			for term in self.terms(token):
+				postings.setdefault(term, set()).add(i)
+		self._terms = sorted(postings)
+		self._postings = [postings[term] for term in self._terms]
+	
+	@staticmethod
+	def colors(token):
+		"""Get the color bitmask of a token"""
+		return color_mask(color for color in color_bits
+			if getattr(token, "is" + color))
+	
+	@staticmethod
+	def key(subtype, power, toughness):
+		"""Get the normalized key of a token description"""
+		words = _re_token_term.findall(subtype.lower())
+		return " ".join(words), str(power), str(toughness)
+	
+	def terms(self, token):
+		"""List the terms a token is indexed under"""
+		l = _re_token_term.findall(token.subtype.lower())
+		if token.power != "" or token.toughness != "":
+			l.append("%s/%s" % (token.power, token.toughness))
+		l.extend(color for color in color_bits if getattr(token, "is" + color))
+		l.extend(_re_token_term.findall(token.setname.lower()))
+		return l
+	
+	def get(self, subtype, power="", toughness="", colors=None):
+		"""Get the tokens with a subtype, power and toughness and, unless
+		colors is None, a color bitmask"""
+		l = self._by_key.get(self.key(subtype, power, toughness), [])
+		return [token for token in l if colors is None or
+			self.colors(token) == colors]
+	
+	def search(self, text, limit=None):
+		"""Get the tokens that have a term starting with every word of the
+		text; sorted by subtype and newest first"""
+		selection = None
+		for word in _re_token_term.findall(text.lower()):
+			matches = set()
+			i = bisect.bisect_left(self._terms, word)
+			while i < len(self._terms) and self._terms[i].startswith(word):
+				matches.update(self._postings[i])
+				i += 1
+			selection = matches if selection is None else selection & matches
+			if not selection:
+				return []
+		if selection is None:
+			return [] # no words
+		l = sorted((self.tokens[i] for i in selection), key=lambda token:
+			(token.subtype, token.power, token.toughness, -token.releasedate))
+		return l if limit is None else l[:limit]
+
+
+def get_token_index():
+	"""Get the TokenIndex of the loaded tokens"""
+	global _token_index
+	if _token_index is None or _token_index.tokens is not tokens:
+		_token_index = TokenIndex(tokens) # tokens have been (re)loaded
+	return _token_index
+
+
+#
+# In the full RAM mode all cards are held in a CardStore. It keeps every card
+# attribute in a column instead of a python object per card: numbers in typed
+# arrays, the few distinct values of columns like the set or the rarity as
+# integer codes into a table, and repeated strings only once. The Card objects
+# handed out by get, find_by_name and cards are light-weight views that are
+# created on demand.
+#
+
+class CardStore(object):
+	"""Column-wise storage of cards"""
+	
+	# Columns with few distinct values, stored as codes into a value table
+	_coded = ("setid", "setname", "cardtype", "subtype", "rarity", "artist")
+	# Numeric columns and their array type
+	_numeric = {"converted_cost": "h", "iswhite": "b", "isblue": "b",
+		"isblack": "b", "isred": "b", "isgreen": "b", "iscolorless": "b",
+		"price": "i", "releasedate": "i", "linkedto": "i", "mana_white": "b",
+		"mana_blue": "b", "mana_black": "b", "mana_red": "b", "mana_green": "b",
+		"mana_generic": "h", "mana_x": "b", "mana_hybrid": "b",
+		"mana_phyrexian": "b", "colors": "b", "identity": "b",
+		"power_variable": "b", "toughness_variable": "b"}
+	# Repeated strings that are shared between cards; reprints share their
+	# rules and flavor text
+	_interned = ("name", "manacost", "power", "toughness", "collectorsid",
+		"text", "flavor")
+	
+	def __init__(self):
+		self.columns = dict()
+		self.values = dict() # value tables of the coded columns
+		self._codes = dict() # value to code mappings of the coded columns
+		self._strings = dict() # table of interned strings
+		self.saved_bytes = 0 # memory saved by sharing repeated values
+		for attr in _card_attributes:
+			if attr in self._coded:
+				self.columns[attr] = array.array("H")
+				self.values[attr] = []
+				self._codes[attr] = dict()
+			elif attr in self._numeric:
+				self.columns[attr] = array.array(self._numeric[attr])
+			else:
+				self.columns[attr] = []
+		self._build_getters()
+	
+	def _build_getters(self):
+		"""Create the fast attribute accessors for every column"""
+		self._getters = dict()
+		for attr in _card_attributes:
+			column = self.columns[attr]
+			if attr in self._coded:
+				values = self.values[attr]
+				getter = lambda i, c=column, v=values: v[c[i]]
+			else:
+				getter = column.__getitem__
+			self._getters[attr] = getter
+	
+	def __len__(self):
+		return len(self.columns["id"])
+	
+	def __getstate__(self):
+		# Arrays are saved as binary strings, which is much faster
+		columns = dict()
+		for attr, column in self.columns.items():
+			if isinstance(column, array.array):
+				column = (column.typecode, column.tostring())
+			columns[attr] = column
+		return columns, self.values, self.saved_bytes
+	
+	def __setstate__(self, state):
+		columns, self.values, self.saved_bytes = state
+		self.columns = dict()
+		for attr, column in columns.items():
+			if isinstance(column, tuple):
+				typecode, data = column
+				column = array.array(typecode)
+				column.fromstring(data)
+			self.columns[attr] = column
+		self._codes = dict()
+		for attr, values in self.values.items():
+			self._codes[attr] = dict((v, i) for i, v in enumerate(values))
+		self._strings = dict()
+		for attr in self._interned:
+			for s in self.columns[attr]:
+				self._strings.setdefault(s, s)
+		self._build_getters()
+	
+	def intern(self, s):
+		"""Return the shared copy of a string"""
+		return self._strings.setdefault(s, s)
+	
+	def extend(self, rows):
+		"""Append cards given as tuples ordered like the database columns"""
+		if len(rows) == 0:
+			return
+		for attr, values in zip(_card_attributes, zip(*rows)):
+			column = self.columns[attr]
+			if attr in self._coded:
+				codes = self._codes[attr]
+				new = set(values).difference(codes)
+				for value in new:
+					codes[value] = len(self.values[attr])
+					self.values[attr].append(value)
+				column.extend(map(codes.__getitem__, values))
+				self.saved_bytes += sum(map(sys.getsizeof, values)) - \
+					sum(map(sys.getsizeof, new))
+			elif attr in self._interned:
+				shared = map(self._strings.setdefault, values, values)
+				column.extend(shared)
+				self.saved_bytes += sum(sys.getsizeof(value) for value, copy in
+					zip(values, shared) if value is not copy)
+			else:
+				column.extend(values)
+	
+	def get(self, index, attr):
+		"""Get a single attribute of a card"""
+		return self._getters[attr](index)
+	
+	def row(self, index):
+		"""Get a card's attributes as a tuple"""
+		return tuple(self._getters[attr](index) for attr in _card_attributes)
+	
+	def view(self, index):
+		"""Get a Card object for the card at index"""
+		return CardView(self, index)
+
+
+class CardView(CardBase):
+	"""A card whose attributes are read from a CardStore"""
+	
+	__slots__ = ("_store", "_index")
+	
+	def __init__(self, store, index):
+		self._store = store
+		self._index = index
+	
+	def __copy__(self):
+		return CardView(self._store, self._index)
+	
+	def as_tuple(self):
+		return self._store.row(self._index)
+
+
+def _view_attribute(attr):
+	"""Create a read-only property that fetches attr from the store"""
+	def getter(self):
+		return self._store._getters[attr](self._index)
+	return property(getter)
+for attr in _card_attributes:
+	setattr(CardView, attr, _view_attribute(attr))
+del attr
+
+
+class CardList(object):
+	"""Read-only sequence of all cards in a CardStore; while the cards are
+	loaded incrementally, using it blocks until all cards are loaded"""
+	
+	def __init__(self, store):
+		self._store = store
+	
+	def __len__(self):
+		wait_loaded("cards")
+		return len(self._store)
+	
+	def __getitem__(self, index):
+		wait_loaded("cards")
+		if isinstance(index, slice):
+			return [self._store.view(i)
+				for i in range(*index.indices(len(self._store)))]
+		if index < 0:
+			index += len(self._store)
+		if not 0 <= index < len(self._store):
+			raise IndexError(index)
+		return self._store.view(index)
+	
+	def __iter__(self):
+		wait_loaded("cards")
+		for i in xrange(len(self._store)):
+			yield self._store.view(i)
+
+
 def create_db(filename):
 	"""Create the sqlite database file"""
 	assert(not os.path.exists(filename))
 	conn = sqlite3.connect(filename)
 	c = conn.cursor()
-	c.execute(u'CREATE TABLE "sets" ("id" TEXT PRIMART KEY, "name" TEXT, ' \
+	c.execute(u'CREATE TABLE "sets" ("id" TEXT PRIMARY KEY, "name" TEXT, ' \
 		'"cards" INTEGER, "releasedate" INTEGER)')
 	c.execute(u'CREATE TABLE "cards" ("id" TEXT PRIMARY KEY, "name" TEXT, ' \
 		'"setid" TEXT, "setname" TEXT, "manacost" TEXT, "converted" INTEGER, '\
@@ -221,16 +843,91 @@ def create_db(filename):
 		'"flavor" TEXT, "artist" TEXT, "power" TEXT, "toughness" TEXT, ' \
 		'"releasedate" INTEGER, "collectorsid" TEXT)')
 	conn.commit()
+	migrations.upgrade(conn)
+
+
+def insert_card(c, card):
+	"""Insert a card into the database using cursor c"""
+	c.execute(u'INSERT INTO "cards" (%s) VALUES (%s)' % (_card_column_list,
+		", ".join(len(_card_columns) * "?")), card.as_tuple())
+
+
+def get_generation(conn):
+	"""Get the database generation; it changes every time the cards change"""
+	c = conn.cursor()
+	c.execute('SELECT "value" FROM "meta" WHERE "key" = ?', ("generation",))
+	row = c.fetchone()
+	return 0 if row is None else row[0]
+
+
+def increment_generation(conn):
+	"""Mark the card data as changed; must be called by any database writer"""
+	c = conn.cursor()
+	c.execute('INSERT OR REPLACE INTO "meta" VALUES (?, ?)',
+		("generation", get_generation(conn) + 1))
+
+
+#
+# To speed up the startup in the full RAM mode, the loaded card data is written
+# to a snapshot file next to the database. It is only used as long as the
+# database file and generation are the same as when the snapshot was taken.
+#
+
+def _snapshot_key():
+	"""Get the values that identify the database state for the snapshot"""
+	db_file = os.path.join(settings.cache_dir, config.DB_FILE)
+	st = os.stat(db_file)
+	return (_SNAPSHOT_VERSION, migrations.SCHEMA_VERSION,
+		get_generation(get_connection()), st.st_mtime, st.st_size)
+
+
+def save_snapshot():
+	"""Write the loaded cards, tokens and sets to the snapshot file"""
+	filename = os.path.join(settings.cache_dir, config.DB_SNAPSHOT_FILE)
+	try:
+		with open(filename + ".tmp", "wb") as f:
+			cPickle.dump(_snapshot_key(), f, 2)
+			cPickle.dump((sets, tokens, _store, _by_id, _by_name,
+				_min_prices), f, 2)
+		if os.name == 'nt' and os.path.exists(filename):
+			os.remove(filename) # windows cannot rename onto existing files
+		os.rename(filename + ".tmp", filename)
+	except (IOError, OSError) as e:
+		logging.warning(_("Could not write the card snapshot: %s"), str(e))
+
+
+def load_snapshot():
+	"""Load the cards, tokens and sets from the snapshot file if it is up to
+	date; returns whether it has been loaded"""
+	global sets, tokens, cards, _store, _by_id, _by_name, _min_prices
+	filename = os.path.join(settings.cache_dir, config.DB_SNAPSHOT_FILE)
+	if not os.path.isfile(filename):
+		return False
+	try:
+		with open(filename, "rb") as f:
+			if cPickle.load(f) != _snapshot_key():
+				logging.info(_("The card snapshot is out of date."))
+				return False
+			sets, tokens, _store, _by_id, _by_name, _min_prices = \
+				cPickle.load(f)
+	except Exception as e:
+		logging.warning(_("Could not read the card snapshot: %s"), str(e))
+		return False
+	cards = CardList(_store)
+	return True
 
 
 def get(cardid):
 	"""Get a card or token by id"""
-	if not settings.save_ram:
+	if not settings.save_ram and (is_loaded("cards") or cardid in _by_id):
+		# Ids are unique, so an indexed card is found even during loading
 		assert(_by_id is not None) # must be initialized
 		if cardid not in _by_id:
 			raise RuntimeError(_("Card id %s not found in database.") % cardid)
-		return _by_id[cardid]
+		entry = _by_id[cardid]
+		return entry if isinstance(entry, Token) else _store.view(entry)
 	else:
+		# The card might not have been loaded yet
 		l = search('"id" = ?', (cardid,), 1)
 		if l == []:
 			raise RuntimeError(_("Card id %s not found in database.") % cardid)
@@ -240,108 +937,518 @@ def get(cardid):
 
 def find_by_name(cardname):
 	"""Return a list of versions of a card by the English name"""
-	if not settings.save_ram:
+	if not settings.save_ram and is_loaded("cards"):
 		assert(_by_name is not None) # must be initialized
 		if cardname not in _by_name:
 			raise RuntimeError(_("Card '%s' not found in database.") % cardname)
-		return _by_name[cardname]
+		return [_store.view(i) for i in _by_name[cardname]]
 	else:
-		l = search('"name" = ? ORDER BY "releasedate"', (cardname,), 1)
+		# While the cards are loaded, only some versions might be indexed
+		l = search('"name" = ? ORDER BY "releasedate"', (cardname,))
+		while not l.complete:
+			l.more()
 		if l == []:
 			raise RuntimeError(_("Card '%s' not found in database.") % cardname)
 		else:
 			return l
 
 
+#
+# Search results are fetched a page at a time. No statement is kept open
+# between pages, as it would hold on to a read transaction of the thread's
+# connection and so keep it from seeing later changes. Every search selects
+# the rowid of the cards as "key": unordered searches continue after the
+# largest key fetched so far, ordered ones (or those with a LIMIT) remember the
+# keys of all matches with the first page and fetch later pages by key.
+#
+
+_re_sql_ordered = re.compile(r'\b(order\s+by|group\s+by|limit)\b', re.I)
+_KEYS_PER_QUERY = 500 # stay below the maximum number of sql parameters
+
+
+def _is_ordered(sql):
+	"""Check if an sql query orders or limits its results"""
+	return any(_re_sql_ordered.search(part) for part in
+		_re_sql_literal.split(sql)[::2])
+
+
+class ResultSet(list):
+	"""A list of search results that fetches further results on demand"""
+	
+	def __init__(self, sql, args=(), cardlist=(), complete=False, last=0):
+		super(ResultSet, self).__init__(cardlist)
+		self.sql = sql
+		self.args = tuple(args)
+		self.complete = complete # have all results been fetched?
+		self.last = last # largest key fetched of an unordered search
+		self._ordered = _is_ordered(sql)
+		self._keys = None # keys of all matches of an ordered search
+	
+	def more(self, limit=settings.results_limit):
+		"""Fetch up to limit further results and return them; can be called
+		from any thread"""
+		if self.complete:
+			return []
+		c = get_connection().cursor()
+		try:
+			if self._ordered:
+				rows = self._fetch_keys(c, limit)
+			else:
+				c.execute('SELECT * FROM (%s) WHERE "key" > ? ORDER BY "key" '
+					'LIMIT ?' % self.sql, self.args + (self.last, limit))
+				rows = c.fetchall()
+				if rows != []:
+					self.last = rows[-1][0]
+				if len(rows) < limit:
+					self.close()
+		finally:
+			c.close()
+		l = [Card(*row[1:]) for row in rows]
+		self.extend(l)
+		return l
+	
+	def _fetch_keys(self, c, limit):
+		"""Get the rows of the next page of an ordered search"""
+		if self._keys is None:
+			c.execute('SELECT "key" FROM (%s)' % self.sql, self.args)
+			self._keys = array.array("l", (row[0] for row in c))
+		keys = self._keys[len(self):len(self) + limit]
+		if len(self) + limit >= len(self._keys):
+			self.close()
+		rows = dict()
+		for i in range(0, len(keys), _KEYS_PER_QUERY):
+			part = keys[i:i + _KEYS_PER_QUERY]
+			c.execute('SELECT "rowid" AS "key", %s FROM "cards" WHERE "rowid" '
+				'IN (%s)' % (_card_column_list, ", ".join("?" * len(part))),
+				tuple(part))
+			rows.update((row[0], row) for row in c)
+		# Cards deleted since the first page are left out
+		return [rows[key] for key in keys if key in rows]
+	
+	def close(self):
+		"""Stop fetching results"""
+		self.complete = True
+		self._keys = None
+
+
+#
+# The results of the first page of every search are kept in an LRU cache with
+# a memory budget of settings.query_cache_size KB. As the cache is keyed on the
+# sql query and its arguments, it is emptied whenever the database generation
+# changes.
+#
+
+class QueryCache(object):
+	"""LRU cache of search results"""
+	
+	def __init__(self):
+		self.hits = 0
+		self.misses = 0
+		self.size = 0 # estimated number of bytes used
+		self._generation = None
+		self._entries = collections.OrderedDict() # oldest entries first
+		self._lock = threading.Lock()
+	
+	def __len__(self):
+		return len(self._entries)
+	
+	def clear(self):
+		"""Remove all entries"""
+		with self._lock:
+			self._entries.clear()
+			self.size = 0
+	
+	def validate(self, generation):
+		"""Clear the cache if the database has changed"""
+		with self._lock:
+			if generation != self._generation:
+				self._entries.clear()
+				self.size = 0
+				self._generation = generation
+	
+	def get(self, key):
+		"""Get the cached (rows, complete, last) for a key or None"""
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None:
+				self.misses += 1
+				return None
+			self._entries[key] = entry # move to the end
+			self.hits += 1
+			return entry[:3]
+	
+	def put(self, key, rows, complete, last):
+		"""Add search results to the cache; the cards are stored as tuples of
+		their attributes, so callers cannot change them"""
+		budget = settings.query_cache_size * 1024
+		size = sys.getsizeof(rows) + sum(map(_row_size, rows))
+		if size > budget / 4:
+			return # would push out too many other entries
+		with self._lock:
+			if key in self._entries:
+				self.size -= self._entries.pop(key)[3]
+			self._entries[key] = rows, complete, last, size
+			self.size += size
+			while self.size > budget:
+				self.size -= self._entries.popitem(last=False)[1][3]
+
+
+_query_cache = QueryCache()
+_re_sql_literal = re.compile(r'(\'[^\']*\'|"[^"]*")')
+_re_white_space = re.compile(r'\s+')
+
+
+def _row_size(row):
+	"""Estimate the number of bytes used by the attributes of a card"""
+	return sys.getsizeof(row) + sum(map(sys.getsizeof, row))
+
+
+def _normalize_sql(sql):
+	"""Normalize the white space in an sql query outside of literals"""
+	parts = _re_sql_literal.split(sql.strip())
+	for i in range(0, len(parts), 2):
+		parts[i] = _re_white_space.sub(" ", parts[i])
+	return "".join(parts)
+
+
+def _cached_search(sql, args, limit):
+	"""Execute a search, answering it from the query cache if possible"""
+	args = tuple(args)
+	_query_cache.validate(get_generation(get_connection()))
+	key = _normalize_sql(sql), args, limit
+	entry = _query_cache.get(key)
+	if entry is not None:
+		rows, complete, last = entry
+		# Every caller gets its own cards
+		return ResultSet(sql, args, [Card(*row) for row in rows], complete,
+			last)
+	results = ResultSet(sql, args)
+	results.more(limit)
+	_query_cache.put(key, tuple(card.as_tuple() for card in results),
+		results.complete, results.last)
+	return results
+
+
+def cache_stats():
+	"""Get the hit and miss counters and the size of the query cache"""
+	return {"hits": _query_cache.hits, "misses": _query_cache.misses,
+		"entries": len(_query_cache), "bytes": _query_cache.size}
+
+
+def _search_sql(query):
+	"""Get the sql of a search for the cards matching a condition"""
+	# The condition may end with an sql comment; the newline ends it, so the
+	# query can be wrapped by ResultSet
+	return 'SELECT "rowid" AS "key", %s FROM "cards" WHERE %s\n' % (
+		_card_column_list, query)
+
 
 def search(query, args=(), limit=settings.results_limit):
-	"""Get a list of cards by sql query"""
-	global _cursor, _limit, _last_search
-	_limit = limit
-	_last_search = 'SELECT * FROM "cards" WHERE ' + query, args
-	_cursor.execute(*_last_search)
-	l = []
-	i = 0
-	for row in _cursor:
-		card = Card(*row)
-		l.append(card)
-		i += 1
-		if i >= _limit:
-			break
-	return l
+	"""Get a list of cards by sql query; returns a ResultSet"""
+	return _cached_search(_search_sql(query), args, limit)
+
+
+#
+# Custom searches can be profiled to find slow queries and missing indexes.
+# The number of virtual machine steps is counted by an sqlite progress handler;
+# it grows with the number of rows sqlite has to look at.
+# The progress handler also aborts searches that have been canceled or have run
+# longer than settings.query_timeout, so a Search can be run in a worker thread
+# and stopped from the main loop.
+#
+
+_PROFILE_STEPS = 100 # virtual machine instructions per counted step
+
+
+class SearchCanceled(Exception):
+	"""The search has been canceled or has taken too long"""
+	pass
+
+
+class QueryProfile(collections.namedtuple("QueryProfile", ("sql", "args",
+		"seconds", "steps", "rows", "plan"))):
+	"""Measurements of a single search"""
+	__slots__ = ()
+	
+	def __str__(self):
+		lines = [_("%d results in %.1f ms, %d virtual machine steps") % (
+			self.rows, 1000 * self.seconds, self.steps), _("Query plan:")]
+		lines.extend("  " + detail for detail in self.plan)
+		return "\n".join(lines)
+
+
+class Search(object):
+	"""A profiled search that can be canceled from another thread"""
+	
+	def __init__(self, query, args=(), limit=settings.results_limit,
+			timeout=None):
+		self.query = query
+		self.sql = _search_sql(query)
+		self.args = tuple(args)
+		self.limit = limit
+		# Maximum run time in milliseconds; 0 means no limit
+		self.timeout = settings.query_timeout if timeout is None else timeout
+		self.canceled = False
+		self.timed_out = False
+		self._steps = 0
+		self._deadline = None
+	
+	def cancel(self):
+		"""Abort the search; can be called from any thread"""
+		self.canceled = True
+	
+	def run(self):
+		"""Execute the search in the calling thread without using the query
+		cache; returns the ResultSet and a QueryProfile"""
+		if self.canceled:
+			raise SearchCanceled(_("The search has been canceled."))
+		conn = get_connection()
+		plan = [row[-1] for row in conn.execute('EXPLAIN QUERY PLAN ' +
+			self.sql, self.args)]
+		start = time.time()
+		if self.timeout > 0:
+			self._deadline = start + self.timeout / 1000.
+		conn.set_progress_handler(self._progress, _PROFILE_STEPS)
+		try:
+			results = ResultSet(self.sql, self.args)
+			results.more(self.limit)
+		except sqlite3.OperationalError:
+			if self.timed_out:
+				raise SearchCanceled(_("The search has taken too long."))
+			if self.canceled:
+				raise SearchCanceled(_("The search has been canceled."))
+			raise
+		finally:
+			conn.set_progress_handler(None, _PROFILE_STEPS)
+		profile = QueryProfile(self.sql, self.args, time.time() - start,
+			self._steps * _PROFILE_STEPS, len(results), plan)
+		logging.info(_("Profiled search %s %r: %d results in %.1f ms, "
+			"%d virtual machine steps, query plan: %s"), self.query,
+			self.args, profile.rows, 1000 * profile.seconds, profile.steps,
+			"; ".join(plan))
+		return results, profile
+	
+	def _progress(self):
+		"""Progress handler; a non-zero return value interrupts the query"""
+		self._steps += 1
+		if self._deadline is not None and time.time() > self._deadline:
+			self.timed_out = True
+		return self.canceled or self.timed_out
+
+
+def profile_search(query, args=(), limit=settings.results_limit):
+	"""Execute a search like search() without using the query cache and
+	measure it; returns the ResultSet and a QueryProfile"""
+	return Search(query, args, limit).run()
+
+
+def fulltext_query(text, column=None):
+	"""Convert user input into a full-text query matching all of its words"""
+	words = _re_fts_word.findall(text.lower())
+	if column is not None:
+		assert(column in migrations.fts_columns)
+		words = ['%s:%s' % (column, word) for word in words]
+	return " ".join(word + "*" for word in words) # match word prefixes
+
+
+def fulltext_condition(text, column=None):
+	"""Get an sql condition for search() that uses the full-text index"""
+	if not _fulltext:
+		return _like_condition(text, column)
+	return ('"rowid" IN (SELECT "docid" FROM "cards_fts" '
+		'WHERE "cards_fts" MATCH ?)', (fulltext_query(text, column),))
+
+
+def _like_condition(text, column=None):
+	"""Get an sql condition matching all words of a text like
+	fulltext_condition, for databases without the full-text index"""
+	columns = migrations.fts_columns if column is None else (column,)
+	conditions = []
+	args = []
+	for word in _re_fts_word.findall(text.lower()):
+		conditions.append("(%s)" % " OR ".join('"%s" LIKE ?' % col
+			for col in columns))
+		args.extend(["%" + word + "%"] * len(columns))
+	if conditions == []:
+		return "0", () # like a full-text query without words
+	return " AND ".join(conditions), tuple(args)
+
+
+def fulltext_search(text, column=None, limit=settings.results_limit):
+	"""Get a list of cards containing all words of a text, best matches
+	first"""
+	query = fulltext_query(text, column)
+	if query == "":
+		return []
+	if not _fulltext:
+		return search(*_like_condition(text, column), limit=limit)
+	columns = ", ".join('"cards"."%s"' % col for col in _card_columns)
+	return _cached_search('SELECT "cards"."rowid" AS "key", ' + columns +
+		' FROM "cards" JOIN '
+		'(SELECT "docid", fts_rank(matchinfo("cards_fts", \'pcx\')) AS "rank" '
+		'FROM "cards_fts" WHERE "cards_fts" MATCH ?) AS "matches" '
+		'ON "cards"."rowid" = "matches"."docid" ORDER BY "matches"."rank" DESC',
+		(query,), limit)
+
+
+def _fts_rank(matchinfo):
+	"""Rank a full-text match; weighted by column, rare words count more"""
+	info = str(matchinfo)
+	values = struct.unpack("%dI" % (len(info) // 4), info)
+	phrases, columns = values[:2]
+	rank = 0.
+	for i in range(phrases * columns):
+		hits, total_hits, docs = values[2 + 3 * i:5 + 3 * i]
+		if hits > 0:
+			rank += _fts_weights[i % columns] * hits / float(total_hits)
+	return rank
+
+
+#
+# Cards without pricing information are valued at the cheapest price of a card
+# with the same name. The "prices" table holds these minimal prices; it is
+# refreshed by update_prices whenever prices change.
+#
+
+def update_prices(c):
+	"""Recompute the cheapest price of every card name using cursor c"""
+	c.execute(u'DELETE FROM "prices"')
+	c.execute(u'INSERT INTO "prices" SELECT "name", MIN("price") FROM "cards" '
+		'WHERE "price" >= 0 GROUP BY "name"')
+
+
+def _chunks(l, size=500):
+	"""Split a list to stay below the number of sql parameters allowed"""
+	l = list(l)
+	return [l[i:i + size] for i in range(0, len(l), size)]
+
+
+def get_min_prices(names):
+	"""Get a dict mapping card names to their cheapest price; names without
+	pricing information are left out"""
+	if not settings.save_ram:
+		assert(_min_prices is not None) # must be initialized
+		wait_loaded("cards")
+		return dict((name, _min_prices[name]) for name in names
+			if name in _min_prices)
+	prices = dict()
+	c = get_connection().cursor()
+	for chunk in _chunks(set(names)):
+		c.execute('SELECT "name", "price" FROM "prices" WHERE "name" IN (%s)'
+			% ", ".join(len(chunk) * "?"), chunk)
+		prices.update(c.fetchall())
+	return prices
+
+
+def get_prices(cardids):
+	"""Get a dict mapping card ids to prices in cents; cards without a price
+	get the cheapest price of a card with the same name, or None"""
+	prices = dict.fromkeys(cardids)
+	if not settings.save_ram:
+		assert(_by_id is not None) # must be initialized
+		wait_loaded("cards")
+		for cardid in prices:
+			i = _by_id.get(cardid)
+			if i is None or isinstance(i, Token):
+				continue
+			price = _store.get(i, "price")
+			if price < 0:
+				price = _min_prices.get(_store.get(i, "name"))
+			prices[cardid] = price
+		return prices
+	c = get_connection().cursor()
+	for chunk in _chunks(prices):
+		c.execute('SELECT "cards"."id", "cards"."price", "prices"."price" '
+			'FROM "cards" LEFT JOIN "prices" '
+			'ON "cards"."name" = "prices"."name" '
+			'WHERE "cards"."id" IN (%s)' % ", ".join(len(chunk) * "?"), chunk)
+		for cardid, price, min_price in c:
+			prices[cardid] = price if price >= 0 else min_price
+	return prices
 
 
 def count():
 	"""Count the number of available cards"""
-	_cursor.execute('SELECT COUNT(*) FROM "cards"')
-	for row in _cursor:
+	c = get_connection().cursor()
+	c.execute('SELECT COUNT(*) FROM "cards"')
+	for row in c:
 		return row[0]
 
 
-def more_results(limit=None):
-	"""Get more results to the last executed sql query"""
-	# FIXME: broken!
-	global _cursor, _limit, _last_search
-	if limit is None:
-		_limit += settings.results_limit
-	else:
-		_limit = limit
-	print _limit
-	_cursor.execute(*_last_search)
-	l = []
-	i = 0
-	for row in _cursor:
-		card = Card(*row)
-		l.append(card)
-		i += 1
-		if i >= _limit:
-			print "Limit reached"
-			break
-	return l
-
-
 def load_tokens():
 	"""Load all tokens from the database to memory"""
 	global tokens
-	_cursor.execute('SELECT * FROM "tokens"')
+	c = get_connection().cursor()
+	c.execute('SELECT * FROM "tokens"')
 	tokens = []
-	for row in _cursor:
-		token = Token(*row)
+	strings = dict() # share repeated strings like the set or the type
+	saved_bytes = 0
+	for row in c:
+		shared = [strings.setdefault(v, v) if isinstance(v, basestring) else v
+			for v in row]
+		saved_bytes += sum(sys.getsizeof(value) for value, copy in
+			zip(row, shared) if value is not copy)
+		token = Token(*shared)
 		tokens.append(token)
+	logging.info(_("Loaded %d tokens; sharing strings saved %d KB"),
+		len(tokens), saved_bytes // 1024)
 
 
-def load_cards():
-	"""Load all cards from the database to memory"""
-	global cards
-	_cursor.execute('SELECT * FROM "cards"')
-	cards = []
-	for row in _cursor:
-		card = Card(*row)
-		cards.append(card)
+def load_cards(chunk_loaded=None):
+	"""Load all cards from the database to memory; chunk_loaded(num) is
+	called after every chunk of num cards"""
+	global cards, _store
+	c = get_connection().cursor()
+	c.execute('SELECT %s FROM "cards"' % _card_column_list)
+	_store = CardStore()
+	cards = CardList(_store)
+	while True:
+		# Load in chunks; duplicates are freed before the next chunk is read
+		rows = c.fetchmany(2000)
+		if rows == []:
+			break
+		_store.extend(rows)
+		if chunk_loaded is not None:
+			chunk_loaded(len(rows))
+	logging.info(_("Loaded %d cards; sharing strings saved %d KB"),
+		len(_store), _store.saved_bytes // 1024)
 
 
 def load_sets():
 	"""Load all cards from the database to memory"""
 	global sets
-	_cursor.execute('SELECT "name" FROM "sets"')
+	c = get_connection().cursor()
+	c.execute('SELECT "name" FROM "sets"')
 	sets = []
-	for row in _cursor:
+	for row in c:
 		sets.append(row[0])
 
 
 def build_datastructures():
-	"""refresh _by_id and _by_name"""
-	global _by_id, _by_name, cards, tokens
+	"""refresh _by_id, _by_name and _min_prices"""
+	global _by_id, _by_name, _min_prices, cards, tokens
 	_by_id = dict()
 	_by_name = dict()
-	for card in cards:
-		_by_id[card.id] = card
-		if card.name in _by_name:
-			_by_name[card.name].append(card)
-		else:
-			_by_name[card.name] = [card]
+	_min_prices = dict()
 	for token in tokens:
 		_by_id[token.id] = token
+	_index_cards(0)
+
+
+def _index_cards(start):
+	"""Add the cards from index start on to _by_id, _by_name and
+	_min_prices"""
+	ids = _store.columns["id"]
+	names = _store.columns["name"]
+	prices = _store.columns["price"]
+	for i in xrange(start, len(_store)):
+		_by_id[ids[i]] = i
+		if names[i] in _by_name:
+			_by_name[names[i]].append(i)
+		else:
+			_by_name[names[i]] = [i]
+		if 0 <= prices[i] < _min_prices.get(names[i], sys.maxint):
+			_min_prices[names[i]] = prices[i]
 
 
 
@@ -0,0 +1,348 @@
+# Written by TheGurke 2012
+"""Structured card searches evaluated on the in-memory cards or in sql"""
+
+import re
+import operator
+import array
+
+from progenitus import settings
+import cards
+
+
+#
+# A Filter describes the conditions of the extended search. In the full RAM
+# mode it is evaluated on the columns of the cards.CardStore: every condition
+# selects a set of cards that is represented as the bits of a python long, and
+# the conditions are combined with bitwise operations. Conditions on columns
+# test every distinct value of the column only once. Columns with few distinct
+# values are then answered from cached posting lists mapping every value to
+# the bits of the cards having it; other columns are scanned for the matching
+# values.
+# In the reduced RAM mode the filter is translated into an sql query instead.
+#
+# Text conditions are sql LIKE patterns: "%" matches any text and "_" any
+# character. Comparisons are (operator, value) tuples with one of the
+# operators "=", "<=" and ">=".
+#
+
+COLORS = ("white", "blue", "black", "red", "green", "colorless")
+
+_ops = {"=": operator.eq, "<=": operator.le, ">=": operator.ge}
+
+_MAX_POSTINGS = 64 # columns with more distinct values are scanned instead
+_postings = dict() # cached posting lists of the current card store
+_postings_store = None # the card store and size the posting lists belong to
+
+
+class Filter(object):
+	"""Conditions of a structured card search"""
+	
+	def __init__(self):
+		self.name = "" # LIKE pattern for the name
+		self.text = "" # words in the rules text (uses the full-text index)
+		self.flavor = "" # words in the flavor text (same)
+		self.artist = "" # LIKE pattern for the artist
+		self.types = [] # LIKE patterns that each match type or subtype
+		self.sets = [] # LIKE patterns; one of them matches the set name
+		self.rarities = [] # the rarity starts with one of these
+		self.colors = set() # the card has one of these colors
+		self.exact_colors = False # the card has exactly the selected colors
+		self.lands = False # select lands like a color
+		self.multicolor = False # at least two colors
+		self.price = None # comparison in cents; cards without price never match
+		self.converted = None # comparison of the converted mana cost
+		self.power = None # comparison
+		self.toughness = None # comparison
+		self.manacost = None # exact mana cost
+		self.contains_mana = None # the mana cost contains these symbols
+	
+	def is_empty(self):
+		"""Check if the filter has no conditions"""
+		return self.to_sql()[0] == ""
+	
+	def to_sql(self):
+		"""Translate the filter into an sql condition and its arguments"""
+		conditions = []
+		args = []
+		def add(condition, *condition_args):
+			conditions.append(condition)
+			args.extend(condition_args)
+		
+		if self.name != "":
+			add('"name" LIKE ?', "%" + self.name + "%")
+		for column in ("text", "flavor"):
+			if getattr(self, column) != "":
+				condition, fts_args = cards.fulltext_condition(
+					getattr(self, column), column)
+				add(condition, *fts_args)
+		if self.artist != "":
+			add('"artist" LIKE ?', "%" + self.artist + "%")
+		for word in self.types:
+			add('("type" LIKE ? OR "subtype" LIKE ?)',
+				*(2 * ["%" + word + "%"]))
+		if self.sets != []:
+			add("(%s)" % " OR ".join(len(self.sets) * ['"setname" LIKE ?']),
+				*["%" + s + "%" for s in self.sets])
+		if self.rarities != []:
+			add("(%s)" % " OR ".join(len(self.rarities) * ['"rarity" LIKE ?']),
+				*[r + "%" for r in self.rarities])
+		
+		# Colors
+		mask = cards.color_mask(self.colors)
+		if self.exact_colors and (self.colors or self.lands):
+			add('"colors" = ?', mask)
+			if self.lands:
+				add('"type" LIKE ?', "%Land%")
+		elif self.colors or self.lands:
+			l = ['"colors" & %d != 0' % mask] if self.colors else []
+			if self.lands:
+				l.append('"type" LIKE \'%Land%\'')
+			add("(%s)" % " OR ".join(l))
+		if self.multicolor:
+			add('("colors" & %d) & (("colors" & %d) - 1) != 0'
+				% (cards.ALL_COLORS, cards.ALL_COLORS))
+		
+		# Comparisons
+		if self.price is not None:
+			add('"price" %s ? AND "price" >= 0' % self.price[0], self.price[1])
+		if self.converted is not None:
+			add('"converted" %s ?' % self.converted[0], self.converted[1])
+		for stat in ("power", "toughness"):
+			for attr, op, value in self._stat_conditions(stat):
+				add('"%s" %s ?' % (attr, op), value)
+		
+		# Mana cost
+		if self.manacost is not None:
+			add('"manacost" = ?', self.manacost)
+		if self.contains_mana is not None:
+			for attr, minimum in self._mana_conditions():
+				add('"%s" >= ?' % cards._card_columns[
+					cards._card_attributes.index(attr)], minimum)
+		
+		return " AND ".join(conditions), args
+	
+	def _mana_conditions(self):
+		"""List the minimum mana symbol counts and converted cost of the
+		contains_mana condition"""
+		cost = cards.parse_mana(self.contains_mana)
+		l = [("mana_" + attr, getattr(cost, attr)) for attr in ("white",
+			"blue", "black", "red", "green", "x", "hybrid", "phyrexian")]
+		l.append(("converted_cost", cost.converted))
+		return [(attr, minimum) for attr, minimum in l if minimum > 0]
+	
+	def _stat_conditions(self, stat):
+		"""List the (attribute, operator, value) conditions comparing power or
+		toughness; a variable stat like 1+* is only known to be at least its
+		fixed part"""
+		if getattr(self, stat) is None:
+			return []
+		op, value = getattr(self, stat)
+		l = [(stat + "_value", op, value)]
+		if op != ">=":
+			l.append((stat + "_variable", "=", 0))
+		return l
+	
+	def evaluate(self):
+		"""Get the indices of all matching cards in the in-memory card store"""
+		cards.wait_loaded("cards")
+		store = cards._store
+		assert(store is not None) # cards must be loaded
+		n = len(store)
+		bits = (1 << n) - 1 # all cards
+		def restrict(selection):
+			return bits & selection
+		
+		if self.name != "":
+			regex = _like_regex("%" + self.name + "%")
+			indices = []
+			for name, l in cards._by_name.iteritems():
+				if name is not None and regex.search(name):
+					indices.extend(l)
+			bits = restrict(_bits(indices, n))
+		if self.text != "":
+			bits = restrict(_fulltext_bits(self.text, "text", n))
+		if self.flavor != "":
+			bits = restrict(_fulltext_bits(self.flavor, "flavor", n))
+		if self.artist != "":
+			bits = restrict(_match_values("artist",
+				_like_regex("%" + self.artist + "%").search))
+		for word in self.types:
+			match = _like_regex("%" + word + "%").search
+			bits = restrict(_match_values("cardtype", match) |
+				_match_values("subtype", match))
+		if self.sets != []:
+			regexes = [_like_regex("%" + s + "%") for s in self.sets]
+			bits = restrict(_match_values("setname",
+				lambda v: any(r.search(v) for r in regexes)))
+		if self.rarities != []:
+			regexes = [_like_regex(r + "%") for r in self.rarities]
+			bits = restrict(_match_values("rarity",
+				lambda v: any(r.search(v) for r in regexes)))
+		
+		# Colors
+		mask = cards.color_mask(self.colors)
+		if self.exact_colors and (self.colors or self.lands):
+			bits = restrict(_match_values("colors", lambda v: v == mask))
+			if self.lands:
+				bits = restrict(_match_values("cardtype",
+					_like_regex("%Land%").search))
+		elif self.colors or self.lands:
+			selection = _match_values("colors", lambda v: v & mask)
+			if self.lands:
+				selection |= _match_values("cardtype",
+					_like_regex("%Land%").search)
+			bits = restrict(selection)
+		if self.multicolor:
+			bits = restrict(_match_values("colors", _is_multicolored))
+		
+		# Comparisons
+		if self.price is not None:
+			op, value = _ops[self.price[0]], self.price[1]
+			bits = restrict(_match_values("price",
+				lambda v: v >= 0 and op(v, value)))
+		if self.converted is not None:
+			op, value = _ops[self.converted[0]], self.converted[1]
+			bits = restrict(_match_values("converted_cost",
+				lambda v: op(v, value)))
+		for stat in ("power", "toughness"):
+			for attr, op, value in self._stat_conditions(stat):
+				bits = restrict(_match_values(attr,
+					lambda v, op=_ops[op], value=value: op(v, value)))
+		
+		# Mana cost
+		if self.manacost is not None:
+			bits = restrict(_match_values("manacost",
+				lambda v: v == self.manacost))
+		if self.contains_mana is not None:
+			for attr, minimum in self._mana_conditions():
+				bits = restrict(_match_values(attr,
+					lambda v, minimum=minimum: v >= minimum))
+		
+		return _indices(bits)
+
+
+class FilterResults(list):
+	"""Search results of a filter with the same interface as
+	cards.ResultSet"""
+	
+	def __init__(self, indices, limit=settings.results_limit):
+		super(FilterResults, self).__init__()
+		self._indices = indices
+		self.complete = False
+		self.more(limit)
+	
+	def more(self, limit=settings.results_limit):
+		"""Get up to limit further results and return them"""
+		i = len(self)
+		l = [cards._store.view(j) for j in self._indices[i:i + limit]]
+		self.extend(l)
+		self.complete = len(self) >= len(self._indices)
+		return l
+
+
+def search(cardfilter, limit=settings.results_limit):
+	"""Get the cards matching a filter; in the reduced RAM mode the search is
+	done in sql"""
+	assert(isinstance(cardfilter, Filter))
+	if settings.save_ram:
+		return cards.search(*cardfilter.to_sql(), limit=limit)
+	return FilterResults(cardfilter.evaluate(), limit)
+
+
+#
+# Helper functions
+#
+
+def _like_regex(pattern):
+	"""Compile an sql LIKE pattern into a regular expression to be used with
+	search()"""
+	regex = "" if pattern.startswith("%") else "^"
+	for char in pattern.strip("%"):
+		if char == "%":
+			regex += ".*"
+		elif char == "_":
+			regex += "."
+		else:
+			regex += re.escape(char)
+	if not pattern.endswith("%") or pattern.strip("%") == "":
+		regex += "$"
+	return re.compile(regex, re.IGNORECASE | re.DOTALL | re.UNICODE)
+
+
+def _is_multicolored(colors):
+	"""Check if a color mask has two or more of the five colors"""
+	colors &= cards.ALL_COLORS
+	return colors & (colors - 1) != 0 # clears the lowest bit
+
+
+def _fulltext_bits(text, column, n):
+	"""Select the cards matching a full-text query"""
+	condition, args = cards.fulltext_condition(text, column)
+	c = cards.get_connection().cursor()
+	c.execute('SELECT "id" FROM "cards" WHERE ' + condition, args)
+	by_id = cards._by_id
+	return _bits((by_id[row[0]] for row in c if row[0] in by_id), n)
+
+
+def _bits(indices, n):
+	"""Create a long with the bits at the given indices set"""
+	digits = bytearray("0" * n)
+	for i in indices:
+		digits[n - 1 - i] = "1"
+	return int(str(digits), 2) if n > 0 else 0
+
+
+def _indices(bits):
+	"""List the positions of the bits set in a long"""
+	return [m.start() for m in re.finditer("1", bin(bits)[:1:-1])]
+
+
+def _get_postings(attr):
+	"""Get the posting lists of a column of the card store, mapping every
+	distinct entry to the bits of the cards having it; entries of coded
+	columns are their codes"""
+	global _postings_store
+	store = cards._store
+	n = len(store)
+	if _postings_store != (store, n):
+		_postings.clear() # cards have been reloaded
+		_postings_store = store, n
+	if attr not in _postings:
+		indices = dict()
+		column = store.columns[attr]
+		for i in xrange(n):
+			entry = column[i]
+			if entry not in indices:
+				indices[entry] = array.array("i")
+			indices[entry].append(i)
+		_postings[attr] = dict((entry, _bits(l, n))
+			for entry, l in indices.iteritems())
+	return _postings[attr]
+
+
+def _match_values(attr, predicate):
+	"""Select the cards whose attribute value satisfies a predicate; like in
+	sql, NULL values never match"""
+	store = cards._store
+	column = store.columns[attr]
+	if attr in store.values:
+		# coded column: test every value once and select by code
+		values = store.values[attr]
+		distinct = len(values)
+		matches = set(code for code, value in enumerate(values)
+			if value is not None and predicate(value))
+	else:
+		entries = set(column)
+		distinct = len(entries)
+		matches = set(value for value in entries
+			if value is not None and predicate(value))
+	if not matches:
+		return 0
+	if distinct <= _MAX_POSTINGS:
+		postings = _get_postings(attr)
+		selection = 0
+		for entry in matches:
+			selection |= postings.get(entry, 0)
+		return selection
+	return _bits((i for i, entry in enumerate(column) if entry in matches),
+		len(column))
@@ -0,0 +1,103 @@
+# Written by TheGurke 2012
+"""Estimate the memory used by the card and picture caches"""
+
+import sys
+import array
+from gettext import gettext as _
+
+import gtk.gdk
+import cairo
+
+import cards
+import filters
+import names
+import pics
+
+
+#
+# The size of a cache is estimated by walking the objects it references and
+# adding up their sys.getsizeof. Objects are counted only once per report, so
+# strings shared between caches are attributed to the first cache listing
+# them. Pictures are counted with the size of their pixel data, which is not
+# known to sys.getsizeof.
+#
+
+
+def sizeof(obj, seen=None):
+	"""Estimate the number of bytes used by an object and the objects it
+	references; objects whose id is in seen are skipped"""
+	if seen is None:
+		seen = set()
+	size = 0
+	stack = [obj]
+	while stack:
+		obj = stack.pop()
+		if obj is None or id(obj) in seen:
+			continue
+		seen.add(id(obj))
+		size += sys.getsizeof(obj)
+		if isinstance(obj, gtk.gdk.Pixbuf):
+			size += obj.get_rowstride() * obj.get_height()
+		elif isinstance(obj, cairo.ImageSurface):
+			size += obj.get_stride() * obj.get_height()
+		elif isinstance(obj, dict):
+			stack.extend(obj.iterkeys())
+			stack.extend(obj.itervalues())
+		elif isinstance(obj, (list, tuple, set, frozenset)):
+			stack.extend(obj)
+		elif isinstance(obj, (basestring, array.array, int, long, float)):
+			pass
+		elif type(obj).__module__.startswith("progenitus"):
+			# Instances of this program's classes
+			if hasattr(obj, "__dict__"):
+				stack.append(obj.__dict__)
+			for cls in type(obj).__mro__:
+				for slot in getattr(cls, "__slots__", ()):
+					stack.append(getattr(obj, slot, None))
+	return size
+
+
+def report():
+	"""List the (name, number of objects, estimated bytes) of every cache"""
+	seen = set()
+	l = []
+	def add(name, obj, num=None):
+		if num is None:
+			num = 0 if obj is None else len(obj)
+		l.append((name, num, sizeof(obj, seen)))
+	
+	# Cards
+	add("cards.cards", cards._store)
+	add("cards._by_id", cards._by_id)
+	add("cards._by_name", cards._by_name)
+	add("cards._min_prices", cards._min_prices)
+	add("cards.tokens", cards.tokens)
+	add("cards.sets", cards.sets)
+	add("cards._token_index", cards._token_index,
+		0 if cards._token_index is None else len(cards._token_index.tokens))
+	add("cards._query_cache", cards._query_cache._entries)
+	add("names._index", names._index)
+	add("filters._postings", filters._postings)
+	if cards._replica is not None:
+		c = cards._replica.cursor()
+		c.execute('PRAGMA page_count')
+		pages = c.fetchone()[0]
+		c.execute('PRAGMA page_size')
+		l.append(("cards._replica", pages, pages * c.fetchone()[0]))
+	
+	# Pictures
+	add("pics._cache", pics._cache._entries)
+	for i, factory in enumerate(pics.factories()):
+		add("pics.PicFactory %d" % (i + 1), factory._cache._entries)
+	return l
+
+
+def format_report():
+	"""Get the memory report as a text table"""
+	lines = ["%-24s %10s %12s" % (_("cache"), _("objects"), _("KB"))]
+	total = 0
+	for name, num, size in report():
+		lines.append("%-24s %10d %12d" % (name, num, size // 1024))
+		total += size
+	lines.append("%-24s %10s %12d" % (_("total"), "", total // 1024))
+	return "\n".join(lines)
@@ -0,0 +1,241 @@
+# Written by TheGurke 2012
+"""Versioned schema upgrades for the card database"""
+
+import sqlite3
+from gettext import gettext as _
+import logging
+
+
+#
+# Every database file records its schema version in the "meta" table. On
+# connect the migrations in the _migrations list are applied in order to bring
+# older files up to date in place, so existing caches do not need to be
+# downloaded again.
+# Never change a migration that has been released; append a new one instead.
+#
+
+fts_columns = ("name", "type", "subtype", "text", "flavor", "artist")
+
+# (index name, table, columns) of the secondary indexes
+_indexes = [
+	("cards_name", "cards", ("name", "releasedate")),
+	("cards_setid", "cards", ("setid",)),
+	("cards_setname", "cards", ("setname",)),
+	("cards_type", "cards", ("type",)),
+	("cards_converted", "cards", ("converted",)),
+	("cards_releasedate", "cards", ("releasedate",)),
+	("cards_price", "cards", ("price",)),
+	("sets_name", "sets", ("name",)),
+]
+
+# Mana symbol counts of the cards, see cards.parse_mana
+mana_columns = ("mana_white", "mana_blue", "mana_black", "mana_red",
+	"mana_green", "mana_generic", "mana_x", "mana_hybrid", "mana_phyrexian")
+
+
+def get_version(conn):
+	"""Get the schema version of a database"""
+	c = conn.cursor()
+	c.execute('SELECT COUNT(*) FROM "sqlite_master" WHERE "name" = ?',
+		("meta",))
+	if c.fetchone()[0] == 0:
+		return 0
+	c.execute('SELECT "value" FROM "meta" WHERE "key" = ?',
+		("schema_version",))
+	row = c.fetchone()
+	return 0 if row is None else row[0]
+
+
+def upgrade(conn):
+	"""Apply all outstanding migrations to a database"""
+	version = get_version(conn)
+	if version == len(_migrations):
+		return # Nothing to do
+	if version > len(_migrations):
+		logging.warning(_("The card database has been created by a newer "
+			"version of this program."))
+		return
+	
+	# Handle the transactions manually; the sqlite3 module would otherwise
+	# commit before every schema change
+	isolation_level = conn.isolation_level
+	conn.isolation_level = None
+	c = conn.cursor()
+	try:
+		c.execute('BEGIN IMMEDIATE') # lock out other upgrading instances
+		c.execute('CREATE TABLE IF NOT EXISTS "meta" ("key" TEXT PRIMARY KEY, '
+			'"value" INTEGER)')
+		version = get_version(conn)
+		for i in range(version, len(_migrations)):
+			description, migration = _migrations[i]
+			logging.info(_("Upgrading the card database: %s"), description)
+			migration(c)
+			c.execute('INSERT OR REPLACE INTO "meta" VALUES (?, ?)',
+				("schema_version", i + 1))
+		c.execute('COMMIT')
+	except:
+		c.execute('ROLLBACK')
+		raise
+	finally:
+		conn.isolation_level = isolation_level
+
+
+def create_index(c, name, table, columns):
+	"""Create an index unless it exists"""
+	c.execute(u'CREATE INDEX IF NOT EXISTS "%s" ON "%s" (%s)' % (name, table,
+		", ".join('"%s"' % col for col in columns)))
+
+
+def has_table(c, name):
+	"""Check if the database contains a table or index"""
+	c.execute('SELECT COUNT(*) FROM "sqlite_master" WHERE "name" = ?', (name,))
+	return c.fetchone()[0] > 0
+
+
+#
+# The full-text index "cards_fts" is an external content fts4 table on top of
+# the cards table. It is kept up to date by triggers, so every process that
+# inserts into "cards" also maintains the index. Sqlite builds without fts4 or
+# the unicode61 tokenizer get no index; full-text searches use LIKE instead.
+#
+
+def has_fulltext_support(c):
+	"""Check if sqlite supports the full-text index"""
+	try:
+		c.execute(u'CREATE VIRTUAL TABLE "temp"."fts_probe" USING fts4('
+			'"text", tokenize=unicode61)')
+	except sqlite3.OperationalError:
+		return False
+	c.execute(u'DROP TABLE "temp"."fts_probe"')
+	return True
+
+
+def create_fulltext_index(c):
+	"""Create the full-text search index and the triggers maintaining it"""
+	cols = ", ".join('"%s"' % col for col in fts_columns)
+	new_cols = ", ".join('new."%s"' % col for col in fts_columns)
+	c.execute(u'CREATE VIRTUAL TABLE "cards_fts" USING fts4(content="cards", '
+		'%s, tokenize=unicode61)' % cols)
+	# The old row has to be removed before the content table changes
+	c.execute(u'CREATE TRIGGER "cards_fts_bd" BEFORE DELETE ON "cards" BEGIN '
+		'DELETE FROM "cards_fts" WHERE "docid" = old."rowid"; END')
+	c.execute(u'CREATE TRIGGER "cards_fts_bu" BEFORE UPDATE OF %s ON "cards" '
+		'BEGIN DELETE FROM "cards_fts" WHERE "docid" = old."rowid"; END' % cols)
+	c.execute(u'CREATE TRIGGER "cards_fts_ai" AFTER INSERT ON "cards" BEGIN '
+		'INSERT INTO "cards_fts" ("docid", %s) VALUES (new."rowid", %s); END'
+		% (cols, new_cols))
+	c.execute(u'CREATE TRIGGER "cards_fts_au" AFTER UPDATE OF %s ON "cards" '
+		'BEGIN INSERT INTO "cards_fts" ("docid", %s) VALUES (new."rowid", %s); '
+		'END' % (cols, cols, new_cols))
+	# Index the rows that are already there
+	c.execute(u'INSERT INTO "cards_fts" ("cards_fts") VALUES (\'rebuild\')')
+
+
+#
+# Migrations
+#
+
+def _fix_sets_key(c):
+	# The sets table was created with a misspelled "PRIMART KEY" constraint
+	c.execute(u'CREATE TABLE "sets_new" ("id" TEXT PRIMARY KEY, "name" TEXT, '
+		'"cards" INTEGER, "releasedate" INTEGER)')
+	c.execute(u'INSERT OR IGNORE INTO "sets_new" SELECT "id", "name", "cards", '
+		'"releasedate" FROM "sets"')
+	c.execute(u'DROP TABLE "sets"')
+	c.execute(u'ALTER TABLE "sets_new" RENAME TO "sets"')
+
+
+def _add_fulltext_index(c):
+	# Databases might have gotten the index before it was a migration
+	if has_table(c, "cards_fts"):
+		return
+	if not has_fulltext_support(c):
+		logging.warning(_("This sqlite version does not support full-text "
+			"searches; searching the card texts will be slow."))
+		return
+	create_fulltext_index(c)
+
+
+def _add_indexes(c):
+	for name, table, columns in _indexes:
+		create_index(c, name, table, columns)
+	c.execute(u'ANALYZE')
+
+
+def _add_mana_columns(c):
+	import cards # imports this module
+	for col in mana_columns:
+		c.execute(u'ALTER TABLE "cards" ADD COLUMN "%s" INTEGER NOT NULL '
+			'DEFAULT 0' % col)
+	c.execute(u'SELECT "rowid", "manacost" FROM "cards"')
+	rows = []
+	for rowid, manacost in c.fetchall():
+		rows.append(tuple(cards.parse_mana(manacost)) + (rowid,))
+	c.executemany(u'UPDATE "cards" SET %s, "converted" = ? WHERE "rowid" = ?'
+		% ", ".join('"%s" = ?' % col for col in mana_columns), rows)
+	for col in mana_columns[:6]: # the colors and the generic amount
+		create_index(c, "cards_" + col, "cards", (col,))
+	c.execute(u'ANALYZE')
+
+
+def _add_color_columns(c):
+	import cards # imports this module
+	for col in ("colors", "identity"):
+		c.execute(u'ALTER TABLE "cards" ADD COLUMN "%s" INTEGER NOT NULL '
+			'DEFAULT 0' % col)
+	colors = ("white", "blue", "black", "red", "green", "colorless")
+	c.execute(u'SELECT "rowid", "manacost", "text", %s FROM "cards"'
+		% ", ".join('"is%s"' % color for color in colors))
+	rows = []
+	for row in c.fetchall():
+		mask = cards.color_mask(color for color, flag in zip(colors, row[3:])
+			if flag)
+		rows.append((mask, cards.identity_mask(mask, u"%s %s" % row[1:3]),
+			row[0]))
+	c.executemany(u'UPDATE "cards" SET "colors" = ?, "identity" = ? '
+		'WHERE "rowid" = ?', rows)
+	create_index(c, "cards_colors", "cards", ("colors",))
+	create_index(c, "cards_identity", "cards", ("identity",))
+	c.execute(u'ANALYZE')
+
+
+def _add_stat_columns(c):
+	import cards # imports this module
+	for stat in ("power", "toughness"):
+		c.execute(u'ALTER TABLE "cards" ADD COLUMN "%s_value" INTEGER' % stat)
+		c.execute(u'ALTER TABLE "cards" ADD COLUMN "%s_variable" INTEGER '
+			'NOT NULL DEFAULT 0' % stat)
+	c.execute(u'SELECT "rowid", "power", "toughness" FROM "cards"')
+	rows = []
+	for rowid, power, toughness in c.fetchall():
+		rows.append(cards.parse_stat(power) + cards.parse_stat(toughness) +
+			(rowid,))
+	c.executemany(u'UPDATE "cards" SET "power_value" = ?, '
+		'"power_variable" = ?, "toughness_value" = ?, "toughness_variable" = ? '
+		'WHERE "rowid" = ?', rows)
+	create_index(c, "cards_power", "cards", ("power_value",))
+	create_index(c, "cards_toughness", "cards", ("toughness_value",))
+	c.execute(u'ANALYZE')
+
+
+def _add_prices_table(c):
+	import cards # imports this module
+	c.execute(u'CREATE TABLE "prices" ("name" TEXT PRIMARY KEY, '
+		'"price" INTEGER)')
+	cards.update_prices(c)
+
+
+# (description, function) of all migrations; the schema version of a database
+# is the number of migrations applied to it
+_migrations = [
+	("fix the primary key of the sets table", _fix_sets_key),
+	("add the full-text search index", _add_fulltext_index),
+	("add indexes on frequently searched columns", _add_indexes),
+	("add the mana symbol columns", _add_mana_columns),
+	("add the color bitmask columns", _add_color_columns),
+	("add the numeric power and toughness columns", _add_stat_columns),
+	("add the table of the cheapest prices", _add_prices_table),
+]
+
+SCHEMA_VERSION = len(_migrations)
+
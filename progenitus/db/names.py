@@ -0,0 +1,172 @@
+# Written by TheGurke 2012
+"""Tolerant lookup of card names"""
+
+import re
+import math
+import unicodedata
+import collections
+from gettext import gettext as _
+import logging
+
+from progenitus import settings
+import cards
+
+
+#
+# Card names are compared in a folded form: lower case, without diacritics
+# and with ligatures written out, so "Aether Vial", "aether vial" and
+# u"\xc6ther Vial" are the same. Split cards are stored like
+# "Fire // Ice (Fire)"; they can also be found by the name in parentheses or by
+# "Fire // Ice".
+# Names that are still not found are matched by their trigrams, the groups of
+# three consecutive characters, which tolerates typos. A misspelled name is
+# only replaced by the most similar name if that one is similar enough and
+# clearly better than the next best match; the replacement is logged.
+#
+
+_ligatures = {u"\xe6": u"ae", u"\u0153": u"oe", u"\xdf": u"ss",
+	u"\u2019": u"'", u"\xb4": u"'", u"`": u"'"}
+_re_white_space = re.compile(r'\s+', re.UNICODE)
+_re_split_card = re.compile(r'^(.*?)\s*\(([^)]*)\)$')
+
+FUZZY_THRESHOLD = 0.5 # minimal similarity of a fuzzy match
+ACCEPT_THRESHOLD = 0.75 # minimal similarity to replace a misspelled name
+ACCEPT_MARGIN = 0.1 # by how much the best match must beat the next one
+CANDIDATE_POSTINGS = 500 # longest trigram posting list to find candidates
+
+_index = None # NameIndex of the card database
+_index_generation = None # database generation the index has been built for
+
+
+def fold(name):
+	"""Get the folded form of a name used for comparison"""
+	if isinstance(name, str):
+		name = name.decode("utf-8", "replace")
+	name = name.lower()
+	for char, replacement in _ligatures.iteritems():
+		name = name.replace(char, replacement)
+	name = unicodedata.normalize("NFKD", name)
+	name = u"".join(c for c in name if not unicodedata.combining(c))
+	return _re_white_space.sub(u" ", name).strip()
+
+
+def aliases(name):
+	"""List the alternative names a card can be referred to by"""
+	match = _re_split_card.match(name)
+	if match is None:
+		return []
+	return [alias for alias in match.groups() if alias != ""]
+
+
+def trigrams(folded):
+	"""Get the set of trigrams of a folded name"""
+	padded = u"  " + folded + u" "
+	return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class NameIndex(object):
+	"""Index of card names for exact, folded and fuzzy lookups"""
+	
+	def __init__(self, names):
+		self._exact = collections.defaultdict(list) # folded name or alias
+		self._names = [] # all names
+		self._trigrams = [] # number of trigrams of every name
+		self._postings = collections.defaultdict(set) # trigram to names
+		for name in set(names):
+			if name is None:
+				continue
+			folded = fold(name)
+			self._exact[folded].append(name)
+			for alias in aliases(name):
+				self._exact[fold(alias)].append(name)
+			grams = trigrams(folded)
+			for gram in grams:
+				self._postings[gram].add(len(self._names))
+			self._names.append(name)
+			self._trigrams.append(len(grams))
+		self._exact = dict(self._exact)
+		self._postings = dict(self._postings)
+	
+	def __len__(self):
+		return len(self._names)
+	
+	def lookup(self, name):
+		"""Get the names equal to name after folding, or having it as an
+		alias"""
+		return list(self._exact.get(fold(name), []))
+	
+	def fuzzy(self, name, limit=5, threshold=FUZZY_THRESHOLD):
+		"""Get up to limit (similarity, name) tuples of the most similar
+		names, best first; the similarity is between 0 and 1"""
+		grams = trigrams(fold(name))
+		postings = sorted((self._postings.get(gram, ()) for gram in grams),
+			key=len)
+		# A name needs min_shared common trigrams to reach the threshold, so
+		# it contains one of the rarest ones; only these yield candidates
+		min_shared = int(math.ceil(threshold * len(grams) / (2. - threshold)))
+		prefix = max(len(grams) - min_shared + 1, 1)
+		# Common trigrams are left out of the candidate search; a misspelled
+		# name still shares enough rare ones with the name it stands for
+		rare = [posting for posting in postings[:prefix]
+			if len(posting) <= CANDIDATE_POSTINGS] or postings[:1]
+		shared = collections.defaultdict(int)
+		for posting in rare:
+			for i in posting:
+				shared[i] += 1
+		# Names much shorter or longer than the query cannot reach the
+		# threshold either
+		low = threshold * len(grams) / (2. - threshold)
+		high = (2. - threshold) * len(grams) / max(threshold, 0.01)
+		shared = dict((i, num) for i, num in shared.iteritems()
+			if low <= self._trigrams[i] <= high)
+		candidates = set(shared)
+		for posting in postings[len(rare):]:
+			for i in candidates.intersection(posting):
+				shared[i] += 1
+		# Dice coefficient of the trigram sets
+		l = []
+		for i, num in shared.iteritems():
+			similarity = 2. * num / (len(grams) + self._trigrams[i])
+			if similarity >= threshold:
+				l.append((similarity, self._names[i]))
+		l.sort(key=lambda t: (-t[0], t[1]))
+		return l[:limit]
+	
+	def find(self, name, threshold=ACCEPT_THRESHOLD, margin=ACCEPT_MARGIN):
+		"""Get the names a possibly misspelled name refers to; a fuzzy match
+		is only used if it is unambiguous"""
+		l = self.lookup(name)
+		if l != []:
+			return l
+		matches = self.fuzzy(name, 2, threshold - margin)
+		if matches == [] or matches[0][0] < threshold:
+			return []
+		if len(matches) > 1 and matches[0][0] - matches[1][0] < margin:
+			return [] # ambiguous
+		logging.warning(_("Card '%s' not found, using '%s' instead."), name,
+			matches[0][1])
+		return [matches[0][1]]
+
+
+def get_index():
+	"""Get the name index of the card database"""
+	global _index, _index_generation
+	generation = cards.get_generation(cards.get_connection())
+	if _index is None or _index_generation != generation:
+		if not settings.save_ram:
+			cards.wait_loaded("cards")
+			names = cards._by_name.keys()
+		else:
+			c = cards.get_connection().cursor()
+			c.execute('SELECT DISTINCT "name" FROM "cards"')
+			names = [row[0] for row in c]
+		_index = NameIndex(names)
+		_index_generation = generation
+	return _index
+
+
+def find(name, threshold=ACCEPT_THRESHOLD, margin=ACCEPT_MARGIN):
+	"""Get the names of the cards in the database a possibly misspelled name
+	refers to"""
+	return get_index().find(name, threshold, margin)
+
@@ -0,0 +1,216 @@
+# Written by TheGurke 2012
+"""Packed archives holding the card pictures of a set"""
+
+import os
+import struct
+import mmap
+import threading
+from gettext import gettext as _
+import logging
+
+from progenitus import config
+from progenitus import settings
+
+
+#
+# With settings.packed_pictures the card pictures of every set are stored in a
+# single archive file instead of one file per card, which saves a directory
+# lookup and an open per picture. The thumbnails of every width are packed
+# into archives per set as well, stored below the thumbnail directory. An
+# archive starts with a header and an index of all pictures, followed by the
+# jpeg data of the pictures:
+#
+#   header: magic "PGPK", format version, number of pictures
+#   index:  for every picture its offset and size in the file, the length of
+#           its card id and the card id
+#
+# Archives are memory mapped, so reading a picture is a slice of the mapping.
+# Token pictures are not packed.
+#
+
+_MAGIC = "PGPK"
+_VERSION = 1
+_header = struct.Struct("<4sHI") # magic, version, number of pictures
+_entry = struct.Struct("<QIH") # offset, size, length of the card id
+
+_packs = dict() # archive file names to open Pack instances
+_lock = threading.Lock()
+
+
+class Pack(object):
+	"""A memory mapped picture archive"""
+	
+	def __init__(self, filename):
+		self.filename = filename
+		with open(filename, "rb") as f:
+			stat = os.fstat(f.fileno())
+			self.stamp = stat.st_mtime, stat.st_size # to notice rewrites
+			self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+		magic, version, num = _header.unpack_from(self._mmap, 0)
+		if magic != _MAGIC or version != _VERSION:
+			self.close()
+			raise ValueError(_("Not a picture archive: %s") % filename)
+		self._index = dict() # card id to (offset, size)
+		pos = _header.size
+		for i in range(num):
+			offset, size, length = _entry.unpack_from(self._mmap, pos)
+			pos += _entry.size
+			cardid = self._mmap[pos:pos + length].decode("utf-8")
+			pos += length
+			self._index[cardid] = offset, size
+	
+	def __contains__(self, cardid):
+		return cardid in self._index
+	
+	def __len__(self):
+		return len(self._index)
+	
+	def cardids(self):
+		"""List the card ids of the pictures in the archive"""
+		return self._index.keys()
+	
+	def read(self, cardid):
+		"""Get the jpeg data of a picture"""
+		offset, size = self._index[cardid]
+		return self._mmap[offset:offset + size]
+	
+	def close(self):
+		"""Unmap the archive"""
+		self._mmap.close()
+
+
+def write(filename, pictures):
+	"""Write an archive from a dict mapping card ids to jpeg data"""
+	cardids = sorted(pictures)
+	names = [cardid.encode("utf-8") for cardid in cardids]
+	offset = _header.size + sum(_entry.size + len(name) for name in names)
+	with open(filename + ".part", "wb") as f:
+		f.write(_header.pack(_MAGIC, _VERSION, len(cardids)))
+		for cardid, name in zip(cardids, names):
+			f.write(_entry.pack(offset, len(pictures[cardid]), len(name)))
+			f.write(name)
+			offset += len(pictures[cardid])
+		for cardid in cardids:
+			f.write(pictures[cardid])
+	if os.path.exists(filename):
+		os.remove(filename) # rename does not replace files on windows
+	os.rename(filename + ".part", filename)
+
+
+def _get_path(cardid, width=None):
+	"""Returns the file path for the archive of a card's set, or the archive
+	of its thumbnails of a width"""
+	path = config.PICS_PACK_PATH(cardid)
+	if width is not None:
+		path = config.THUMBNAILS_PATH(width, path)
+	return os.path.join(settings.cache_dir, path)
+
+
+def _open(filename):
+	"""Get the open archive of a file name or None if there is none"""
+	try:
+		stat = os.stat(filename)
+	except OSError:
+		_forget(filename)
+		return None # no archive
+	with _lock:
+		pack = _packs.get(filename)
+		if pack is not None and pack.stamp == (stat.st_mtime, stat.st_size):
+			return pack
+		if pack is not None:
+			pack.close() # the updater has written a new archive
+			del _packs[filename]
+		try:
+			pack = _packs[filename] = Pack(filename)
+		except (ValueError, struct.error, EnvironmentError) as e:
+			logging.warning(_("Could not open the picture archive %s: %s"),
+				filename, str(e))
+			return None
+		return pack
+
+
+def _forget(filename):
+	"""Close an archive so it is opened again on the next access"""
+	with _lock:
+		pack = _packs.pop(filename, None)
+		if pack is not None:
+			pack.close()
+
+
+def contains(cardid, width=None):
+	"""Check if the picture of a card, or its thumbnail of a width, is in an
+	archive"""
+	pack = _open(_get_path(cardid, width))
+	return pack is not None and cardid in pack
+
+
+def read(cardid, width=None):
+	"""Get the jpeg data of a card picture, or its thumbnail of a width, from
+	its archive or None"""
+	pack = _open(_get_path(cardid, width))
+	if pack is None or cardid not in pack:
+		return None
+	return pack.read(cardid)
+
+
+def _pack_directory(directory, filename):
+	"""Move the jpeg files of a directory into an archive; returns the number
+	of pictures in the archive"""
+	files = []
+	if os.path.isdir(directory):
+		files = [name for name in os.listdir(directory)
+			if name.endswith(".jpg")]
+	pack = _open(filename)
+	if files == []:
+		return 0 if pack is None else len(pack) # nothing to do
+	
+	# Merge the new pictures into the existing archive
+	pictures = dict()
+	if pack is not None:
+		for cardid in pack.cardids():
+			pictures[cardid] = pack.read(cardid)
+	for name in files:
+		with open(os.path.join(directory, name), "rb") as f:
+			pictures[name[:-4]] = f.read()
+	_forget(filename)
+	if not os.path.isdir(os.path.dirname(filename)):
+		os.makedirs(os.path.dirname(filename))
+	write(filename, pictures)
+	
+	# Remove the loose files
+	for name in files:
+		os.remove(os.path.join(directory, name))
+	if os.listdir(directory) == []:
+		os.rmdir(directory)
+	return len(pictures)
+
+
+def pack_set(setcode):
+	"""Move the loose picture files and thumbnails of a set into its archives;
+	returns the number of pictures in the archive"""
+	cardid = setcode + ".000" # any card of the set
+	path = config.CARD_PICS_PATH(cardid)
+	for width in config.THUMBNAIL_WIDTHS:
+		directory = os.path.dirname(os.path.join(settings.cache_dir,
+			config.THUMBNAILS_PATH(width, path)))
+		_pack_directory(directory, _get_path(cardid, width))
+	directory = os.path.dirname(os.path.join(settings.cache_dir, path))
+	return _pack_directory(directory, _get_path(cardid))
+
+
+def pack_all():
+	"""Convert the loose picture files of all sets into archives; returns the
+	number of sets converted"""
+	directories = [os.path.join(settings.cache_dir, "cards")]
+	directories.extend(os.path.join(settings.cache_dir,
+		config.THUMBNAILS_PATH(width, "cards"))
+		for width in config.THUMBNAIL_WIDTHS)
+	setcodes = set()
+	for directory in directories:
+		if os.path.isdir(directory):
+			setcodes.update(name for name in os.listdir(directory)
+				if os.path.isdir(os.path.join(directory, name)))
+	for setcode in sorted(setcodes):
+		logging.info(_("Packing the pictures of %s"), setcode)
+		pack_set(setcode)
+	return len(setcodes)
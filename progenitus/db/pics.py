@@ -2,24 +2,133 @@
 """Manage access to the cached card pictures"""
 
 import math
+import time
 import os.path
-import datetime
+import weakref
+import threading
+import collections
+import Queue
 from gettext import gettext as _
 import logging
 
+import glib
 import gtk.gdk
 import cairo
 
 from progenitus import config
 from progenitus import settings
 import cards
+import packs
 
 #
 # Given a card id it returns the corresponding picture as a gdk.Pixbuf
 #
+# Decoded pictures are kept in an LRU cache with a memory budget of
+# settings.picture_cache_size KB, a quarter of it in the reduced RAM mode.
+# Pictures that are on screen can be pinned by the widget showing them; pinned
+# pictures are only evicted when no other pictures are left and the pinned
+# ones alone exceed the budget.
+# The scaled pictures of every PicFactory are kept in another such cache, with
+# a budget of settings.surface_cache_size KB.
+#
+
+
+class PictureCache(object):
+	"""LRU cache of decoded pictures or scaled surfaces"""
+	
+	def __init__(self, budget_setting="picture_cache_size"):
+		self.budget_setting = budget_setting # name of the budget setting
+		self.hits = 0
+		self.misses = 0
+		self.evictions = 0
+		self.size = 0 # number of bytes used
+		self._entries = collections.OrderedDict() # oldest entries first
+		self._pins = weakref.WeakKeyDictionary() # owner to pinned card ids
+		self._lock = threading.Lock()
+	
+	def __len__(self):
+		return len(self._entries)
+	
+	def budget(self):
+		"""Get the memory budget in bytes"""
+		budget = getattr(settings, self.budget_setting) * 1024
+		return budget // 4 if settings.save_ram else budget
+	
+	def clear(self):
+		"""Remove all pictures"""
+		with self._lock:
+			self._entries.clear()
+			self.size = 0
+	
+	def get(self, key, count=True):
+		"""Get a cached picture or None; count tells if the lookup is to be
+		counted as a hit or a miss"""
+		with self._lock:
+			entry = self._entries.pop(key, None)
+			if entry is None:
+				if count:
+					self.misses += 1
+				return None
+			self._entries[key] = entry # move to the end
+			if count:
+				self.hits += 1
+			return entry[0]
+	
+	def put(self, key, picture):
+		"""Add a gdk.Pixbuf or a cairo.ImageSurface"""
+		if isinstance(picture, cairo.ImageSurface):
+			size = picture.get_stride() * picture.get_height()
+		else:
+			size = picture.get_rowstride() * picture.get_height()
+		with self._lock:
+			if key in self._entries:
+				self.size -= self._entries.pop(key)[1]
+			self._entries[key] = picture, size
+			self.size += size
+			self._evict()
+	
+	def pin(self, owner, cardids):
+		"""Set the pictures pinned by an owner, replacing its previous pins"""
+		with self._lock:
+			self._pins[owner] = frozenset(cardids)
+	
+	def stats(self):
+		"""Get the counters and the size"""
+		return {"hits": self.hits, "misses": self.misses,
+			"evictions": self.evictions, "entries": len(self),
+			"bytes": self.size}
+	
+	def _evict(self):
+		"""Remove the least recently used pictures until the budget is met"""
+		budget = self.budget()
+		if self.size <= budget:
+			return
+		pinned = set()
+		for cardids in self._pins.values():
+			pinned.update(cardids)
+		for key in self._entries.keys(): # oldest first
+			if self.size <= budget:
+				return
+			cardid = key[0] if isinstance(key, tuple) else key
+			if cardid not in pinned:
+				self.size -= self._entries.pop(key)[1]
+				self.evictions += 1
+		# The pinned pictures alone exceed the budget
+		while self.size > budget and self._entries:
+			self.size -= self._entries.popitem(last=False)[1][1]
+			self.evictions += 1
+
 
+_cache = PictureCache()
+_factories = weakref.WeakSet() # all PicFactory instances
 
-_map = dict() # data structure to hold the pics
+DECODE_THREADS = 2 # number of threads decoding pictures in the background
+_decode_queue = Queue.Queue() # (card id, thumbnail width) to be decoded
+_decoders = [] # the decoding threads
+_pending = dict() # pictures being decoded to the callbacks waiting for them
+_pending_lock = threading.Lock()
+_failed = dict() # card ids whose pictures could not be loaded to the time
+RETRY_FAILED = 60 # seconds until a picture that failed to load is tried again
 
 
 def _get_path(cardid):
@@ -32,54 +141,289 @@ def _get_path(cardid):
 		return os.path.join(settings.cache_dir, config.CARD_PICS_PATH(cardid))
 
 
-def _load(cardid):
-	"""Load a card picture from the disk"""
+def _is_packed(cardid):
+	"""Check if the pictures of a card are looked up in the archives"""
+	return settings.packed_pictures and cardid != "deckmaster" and \
+		not cards.is_token(cardid)
+
+
+def exists(cardid):
+	"""Check if the picture of a card is in the cache"""
+	if _is_packed(cardid) and packs.contains(cardid):
+		return True
+	return os.path.isfile(_get_path(cardid))
+
+
+def _get_thumbnail_path(cardid, width):
+	"""Returns the file path for a thumbnail of the card picture"""
+	if cards.is_token(cardid):
+		path = config.TOKEN_PICS_PATH(cardid)
+	else:
+		path = config.CARD_PICS_PATH(cardid)
+	return os.path.join(settings.cache_dir, config.THUMBNAILS_PATH(width, path))
+
+
+def _thumbnail_width(cardid, width):
+	"""Get the width of the smallest thumbnail at least width wide or None if
+	the full picture is to be used"""
+	if width is None or cardid == "deckmaster":
+		return None
+	for thumbnail_width in config.THUMBNAIL_WIDTHS:
+		if thumbnail_width >= width:
+			return thumbnail_width
+	return None
+
+
+def _thumbnail_exists(cardid, width):
+	"""Check if a thumbnail of a card picture has been written"""
+	if _is_packed(cardid) and packs.contains(cardid, width):
+		return True
+	return os.path.isfile(_get_thumbnail_path(cardid, width))
+
+
+def _decode_data(data):
+	"""Decode the jpeg data of a picture"""
+	loader = gtk.gdk.PixbufLoader()
+	loader.write(data)
+	loader.close()
+	return loader.get_pixbuf()
+
+
+def _read(cardid):
+	"""Decode the full card picture"""
+	if _is_packed(cardid):
+		data = packs.read(cardid)
+		if data is not None:
+			return _decode_data(data)
 	filename = _get_path(cardid)
 	if not os.path.isfile(filename):
 		if cards.is_token(cardid):
 			logging.error(_("Picture for token %s not found."), cardid)
 		else:
 			logging.error(_("Picture for card %s not found."), cardid)
-	pixbuf = gtk.gdk.pixbuf_new_from_file(filename).add_alpha(False, 0, 0, 0)
-	global _map
-	if not settings.save_ram:
-		_map[cardid] = pixbuf
+	# Cairo and gtk draw pictures without an alpha channel just as well
+	return gtk.gdk.pixbuf_new_from_file(filename)
+
+
+def _load(cardid, thumbnail_width=None):
+	"""Load a card picture or one of its thumbnails from the disk"""
+	if thumbnail_width is None:
+		pixbuf = _read(cardid)
+	else:
+		data = None
+		if _is_packed(cardid):
+			data = packs.read(cardid, thumbnail_width)
+		filename = _get_thumbnail_path(cardid, thumbnail_width)
+		if data is not None:
+			pixbuf = _decode_data(data)
+		elif os.path.isfile(filename):
+			pixbuf = gtk.gdk.pixbuf_new_from_file(filename)
+		else:
+			full = _cache.get((cardid, None), False) or _read(cardid)
+			pixbuf = _write_thumbnail(cardid, full, thumbnail_width)
+	_cache.put((cardid, thumbnail_width), pixbuf)
+	return pixbuf
+
+
+def get(cardid, width=None):
+	"""Get the pixmap for a card or token; if width is given it may be a
+	thumbnail that is at least that wide"""
+	thumbnail_width = _thumbnail_width(cardid, width)
+	pixbuf = _cache.get((cardid, thumbnail_width))
+	if pixbuf is None:
+		return _load(cardid, thumbnail_width)
 	return pixbuf
 
 
+#
+# Thumbnails are pre-scaled copies of the card pictures in the widths
+# config.THUMBNAIL_WIDTHS, stored in the cache directory next to the full
+# pictures. Drawing a card on the table starts from the smallest thumbnail at
+# least as wide as needed, which is much faster to decode and smaller in memory
+# than the full picture. Thumbnails are written by the updater or on first use;
+# with settings.packed_pictures the updater packs them like the full pictures.
+#
+
+def _write_thumbnail(cardid, pixbuf, width):
+	"""Save a thumbnail of a card picture and return it"""
+	if pixbuf.get_width() <= width:
+		# The picture is small enough already; save a copy anyway, or it
+		# would be decoded again every time the thumbnail is looked for
+		thumbnail = pixbuf
+	else:
+		height = int(round(pixbuf.get_height() * float(width) /
+			pixbuf.get_width()))
+		thumbnail = pixbuf.scale_simple(width, height, gtk.gdk.INTERP_HYPER)
+	filename = _get_thumbnail_path(cardid, width)
+	try:
+		if not os.path.isdir(os.path.dirname(filename)):
+			os.makedirs(os.path.dirname(filename))
+		# Write to a temporary file first, so a thumbnail being written by
+		# another thread is never read half-finished
+		thumbnail.save(filename + ".part", "jpeg", {"quality": "90"})
+		os.rename(filename + ".part", filename)
+	except (glib.GError, OSError) as e:
+		logging.warning(_("Could not save the thumbnail %s: %s"), filename,
+			str(e))
+	return thumbnail
+
+
+def make_thumbnails(cardid):
+	"""Write all thumbnails of a card picture that do not exist yet"""
+	pixbuf = None
+	for width in config.THUMBNAIL_WIDTHS:
+		if not _thumbnail_exists(cardid, width):
+			if pixbuf is None:
+				# Do not use the cache; the updater handles many pictures
+				try:
+					pixbuf = _read(cardid)
+				except glib.GError as e:
+					logging.warning(_("Could not load the picture of %s: %s"),
+						cardid, str(e))
+					return
+			_write_thumbnail(cardid, pixbuf, width)
+
+
+#
+# Widgets that must not block the main loop request pictures with request().
+# Pictures that are not cached are decoded by a pool of background threads; the
+# widget shows placeholder() in the mean time and gets a callback in the main
+# loop as soon as the picture is ready, so it can repaint.
+#
+
+def request(cardid, callback, width=None):
+	"""Get the pixmap for a card like get() if it is cached; otherwise decode
+	it in the background, call callback(cardid) in the main loop when it is
+	ready and return None. Pictures that cannot be loaded are replaced by the
+	placeholder and tried again after RETRY_FAILED seconds."""
+	key = cardid, _thumbnail_width(cardid, width)
+	pixbuf = _cache.get(key)
+	if pixbuf is not None:
+		return pixbuf
+	if cardid in _failed:
+		if time.time() - _failed[cardid] < RETRY_FAILED:
+			return placeholder()
+		del _failed[cardid] # the updater might have downloaded it meanwhile
+	with _pending_lock:
+		if key in _pending:
+			_pending[key].append(callback)
+			return None # already being decoded
+		_pending[key] = [callback]
+		while len(_decoders) < DECODE_THREADS:
+			thread = threading.Thread(target=_decode)
+			thread.daemon = True
+			thread.start()
+			_decoders.append(thread)
+	_decode_queue.put(key)
+	return None
+
 
-def get(cardid):
-	"""Get the pixmap for a card or token"""
-	global _map
-	if cardid not in _map:
-		return _load(cardid)
-	return _map[cardid]
+def placeholder():
+	"""Get the pixmap to show while a picture is being decoded"""
+	return get("deckmaster")
 
 
+def _decode():
+	"""Decode the requested pictures; runs in a decoding thread"""
+	while True:
+		key = _decode_queue.get()
+		cardid, thumbnail_width = key
+		try:
+			_load(cardid, thumbnail_width) # request() counted the cache miss
+		except Exception as e:
+			# Keep the thread alive whatever goes wrong with a picture
+			logging.error(_("Could not load the picture of %s: %s"), cardid,
+				str(e))
+			_failed[cardid] = time.time() # show the placeholder instead
+		finally:
+			with _pending_lock:
+				callbacks = _pending.pop(key, [])
+		glib.idle_add(_notify, callbacks, cardid)
+
+
+def _notify(callbacks, cardid):
+	"""Tell the waiting widgets that a picture is ready"""
+	for callback in callbacks:
+		callback(cardid)
+	return False # do not call again
+
+
+def pin(owner, cardids):
+	"""Keep the pictures of the given cards in the cache while they are shown
+	by owner; replaces the pictures previously pinned by owner"""
+	_cache.pin(owner, cardids)
+
+
+def cache_stats():
+	"""Get the counters and the size of the picture cache"""
+	return _cache.stats()
+
+
+
+# Scaled surfaces are made in widths that are multiples of this step and
+# scaled down to the exact width when painted, so zooming the desktop does not
+# fill the surface cache with a set of surfaces for every pixel width
+SURFACE_WIDTH_STEP = 16
+
 
 class PicFactory(object):
 	"""Data structure managing scaled images"""
 	
 	def __init__(self):
-		self._map = dict()
+		# Surfaces by card id and rounded width; a card can be shown in
+		# several sizes at once, like tapped and untapped or in the hand
+		self._cache = PictureCache("surface_cache_size")
+		self.drawn = set() # card ids requested since this has been cleared
+		_factories.add(self)
 	
-	def _update(self, cardid, width):
-		"""Update the entry at cardid"""
-		pixbuf = get(cardid)
-		width = math.ceil(width)
+	def _update(self, cardid, width, pixbuf):
+		"""Scale the picture of a card to a width"""
 		zoom = width * (1. / pixbuf.get_width())
 		surface, w, h = surface_from_pixbuf(pixbuf, zoom)
-		#assert(w == int(width)) # might fail due to flop errors
-		self._map[cardid] = surface, int(width), datetime.datetime.now()
+		#assert(w == width) # might fail due to flop errors
+		self._cache.put((cardid, width), surface)
+		return surface
 	
-	def get(self, cardid, width):
-		"""Get the scaled cairo surface for a card"""
-		if cardid not in self._map:
-			self._update(cardid, width)
-		surface, w, creation_time = self._map[cardid]
-		if w != width:
-			self._update(cardid, width)
-		return self._map[cardid][0]
+	def get(self, cardid, width, repaint=None):
+		"""Get the scaled cairo surface for a card; it is at least width pixels
+		wide, but can be up to SURFACE_WIDTH_STEP - 1 pixels wider. If repaint
+		is given and the picture is not decoded yet, a placeholder is returned
+		and repaint() is called once the picture is ready"""
+		self.drawn.add(cardid)
+		width = int(math.ceil(width / float(SURFACE_WIDTH_STEP)))
+		width = max(width, 1) * SURFACE_WIDTH_STEP
+		surface = self._cache.get((cardid, width))
+		if surface is None:
+			if repaint is None or cardid == "deckmaster":
+				pixbuf = get(cardid, width)
+			else:
+				pixbuf = request(cardid, lambda cardid: repaint(), width)
+				if pixbuf is None or cardid in _failed:
+					# Show the placeholder, but do not keep it for this card
+					# so the picture is tried again later
+					return self.get("deckmaster", width)
+			surface = self._update(cardid, width, pixbuf)
+		return surface
+	
+	def paint(self, cr, cardid, width, repaint=None):
+		"""Paint the picture of a card with the given width at the current
+		origin of a cairo context"""
+		surface = self.get(cardid, width, repaint)
+		zoom = float(width) / surface.get_width()
+		cr.save()
+		cr.scale(zoom, zoom)
+		cr.set_source_surface(surface)
+		cr.paint()
+		cr.restore()
+	
+	def stats(self):
+		"""Get the counters and the size of the scaled surfaces"""
+		return self._cache.stats()
+
+
+def factories():
+	"""List the existing PicFactory instances"""
+	return list(_factories)
 
 
 def surface_from_pixbuf(pixbuf, zoom=1., antialiasing=True):
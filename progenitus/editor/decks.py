@@ -10,9 +10,11 @@ import os
 from gettext import gettext as _
 import logging
 
+from progenitus import async
 from progenitus import config
 from progenitus import settings
 from progenitus.db import cards
+from progenitus.db import names
 
 #
 # About the deck format:
@@ -63,18 +65,22 @@ class Deck(object):
 	
 	def derive_color(self):
 		"""List a deck's color"""
-		self.color = []
-		for c in ["white", "blue", "black", "red", "green"]:
-			l = filter(lambda card: getattr(card, "is" + c), self.decklist)
-			if len(l) > 3:
-				self.color.append(c)
+		colors = ["white", "blue", "black", "red", "green"]
+		counts = dict.fromkeys(colors, 0)
+		for card in self.decklist:
+			for c in colors:
+				if card.colors & cards.color_bits[c]:
+					counts[c] += 1
+		self.color = [c for c in colors if counts[c] > 3]
 	
 	def get_price(self):
 		"""Get the estimated price of all the cards in this deck"""
+		prices = cards.get_prices(card.id for card in
+			self.decklist + self.sideboard)
 		price = 0
-		for card in self.deck + self.sideboard:
-			if card.price >= 0:
-				price += card.price
+		for card in self.decklist + self.sideboard:
+			if prices[card.id] is not None:
+				price += prices[card.id]
 		return price
 	
 	def add(self, cardid, sideboard=False):
@@ -104,7 +110,7 @@ class Deck(object):
 			for l in (self.decklist, self.sideboard):
 				for i in range(len(l)):
 					card = l[i]
-					assert(isinstance(card, cards.Card))
+					assert(isinstance(card, cards.CardBase))
 					if card in l[:i]:
 						continue # already processed
 					num = len([c for c in l[i:] if c == card])
@@ -162,23 +168,18 @@ def load(filename, progresscallback=None, returncallback=None):
 	if not os.access(filename, os.W_OK):
 		deck.readonly = True
 	
-	# lookup in the db
+	# lookup in the db; the name index might have to be built first
+	index = yield async.threaded(names.get_index)
 	for i in range(len(cardlist)):
 		num, name, setname, sb = cardlist[i]
-		try:
-			l = yield cards.find_by_name(name)
-		except RuntimeError:
-			# try to find card by adding parenthesis
-			name = "%(" + name + ")%"
-			if setname is not None:
-				l = yield cards.search('"setname" = ? AND "name" LIKE ?'
-					' ORDER BY "releasedate" DESC', (setname, name))
-			if setname is None or l == []:
-				l = yield cards.search('"name" LIKE ?' +
-					' ORDER BY "releasedate" DESC', (name,))
-			if l == []:
-				logging.error("Card '%s' not found.", name[2:-2])
-				continue
+		# tolerates case, diacritics, split card names and typos
+		cardnames = yield index.find(name)
+		l = []
+		for cardname in cardnames:
+			l.extend(cards.find_by_name(cardname))
+		if l == []:
+			logging.error("Card '%s' not found.", name)
+			continue
 		if setname is not None:
 			ll = filter(lambda card: card.setname == setname, l)
 			if ll != []:
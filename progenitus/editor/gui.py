@@ -4,6 +4,7 @@
 import os
 import sqlite3
 import re
+import collections
 import shutil
 import subprocess
 from gettext import gettext as _
@@ -16,6 +17,7 @@ import pango
 
 from progenitus import *
 from progenitus.db import cards
+from progenitus.db import filters
 from progenitus.db import pics
 import decks
 
@@ -33,6 +35,10 @@ class Interface(uiloader.Interface):
 	isfullscreen = False
 	_enlarged_card = None
 	_select_active = True
+	_results = None # the currently displayed search results
+	_shown_picture = None # id of the card whose picture is shown
+	_search = None # the running custom search
+	_search_task = None # handle of the running search task
 	
 	def __init__(self):
 		super(self.__class__, self).__init__()
@@ -64,7 +70,7 @@ class Interface(uiloader.Interface):
 			self.warn_about_empty_db()
 			return
 		
-		cards.connect()
+		cards.connect(incremental=True)
 		num = cards.count()
 		if num == 0:
 			self.warn_about_empty_db()
@@ -116,6 +122,7 @@ class Interface(uiloader.Interface):
 		if not settings.save_ram:
 			# Because it requires a lot of RAM, the card and card type
 			# autocomplete feature is not available in the reduced RAM mode
+			yield async.threaded(cards.wait_loaded, "cards")
 			subtypes = dict()
 			for card in cards.cards:
 				for subtype in card.subtype.split(" "):
@@ -131,7 +138,7 @@ class Interface(uiloader.Interface):
 						" <span size=\"x-small\">(Creature type)</span>")
 					self.liststore_qs_autocomplete.append((subtype, desc,
 						'"subtype" LIKE ?', "%" + subtype + "%"))
-					cardnames = yield set(card.name for card in cards.cards)
+			cardnames = yield set(card.name for card in cards.cards)
 			for cardname in cardnames:
 				card = yield cards.find_by_name(cardname)[0]
 				desc = card.name + " <span size=\"x-small\">" + card.cardtype
@@ -252,7 +259,9 @@ class Interface(uiloader.Interface):
 	
 	def more_results(self, widget):
 		"""Get more results to the previously executed search query"""
-		self._show_results(cards.more_results())
+		if self._results is not None:
+			self._results.more()
+			self._show_results(self._results)
 	
 	def sqlquery_keypress(self, widget, event):
 		"""Keypress on the textview_sqlquery"""
@@ -889,11 +898,13 @@ class Interface(uiloader.Interface):
 	def show_card(self, cardid):
 		"""Show a card picture and information"""
 		self.hbuttonbox_transform.hide()
+		pics.pin(self, [] if cardid is None else [cardid])
+		self._shown_picture = cardid
 		if cardid is not None:
-			try:
-				self.cardpic.set_from_pixbuf(pics.get(cardid))
-			except RuntimeError:
-				pass # If there is not picture, continue anyways
+			# Decode the picture in the background, see _show_card_picture
+			pixbuf = pics.request(cardid, self._show_card_picture)
+			self.cardpic.set_from_pixbuf(pics.placeholder() if pixbuf is None
+				else pixbuf)
 			card = cards.get(cardid)
 			self._enlarged_card = card
 			self.carddetails.set_markup(card.markup())
@@ -902,6 +913,12 @@ class Interface(uiloader.Interface):
 		else:
 			self.cardpic.set_from_pixbuf(pics.get("deckmaster"))
 	
+	def _show_card_picture(self, cardid):
+		"""A card picture has been decoded"""
+		if cardid == self._shown_picture:
+			self.cardpic.set_from_pixbuf(pics.request(cardid,
+				self._show_card_picture) or pics.placeholder())
+	
 	def transform_card(self, widget):
 		"""View the respective transformed card"""
 		card = self._enlarged_card
@@ -1067,16 +1084,12 @@ class Interface(uiloader.Interface):
 	def quicksearch(self, widget):
 		"""Pressed enter on the quicksearch field"""
 		query = self.quicksearch_entry.get_text()
-		i = 0
-		for q in ['"id" == ?', '"manacost" == ?',
-				'"name" LIKE ? OR "type" LIKE ? OR "subtype" LIKE ?',
-				'"setname" LIKE ?', '"artist" LIKE ?', '"text" LIKE ?']:
-			l = cards.search(q, (query,) * q.count("?"))
-			if l != []:
-				break
-			i += 1
-			if i >= 2:
-				query = "%" + _replace_chars(query) + "%"
+		self._start_search(self._run_quicksearch(query))
+	
+	def _run_quicksearch(self, query):
+		"""Run the quicksearch in a worker thread and show its results"""
+		l = yield async.threaded(_quicksearch, query)
+		self._search_task = None
 		if l == []:
 			self.quicksearch_entry.modify_base(gtk.STATE_NORMAL,
 				gtk.gdk.color_parse("#A51818"))
@@ -1114,116 +1127,69 @@ class Interface(uiloader.Interface):
 	def search(self, widget):
 		"""Execute the extended search"""
 		
-		# Construct query
-		query = ''
-		args = []
-		name = self.entry_name.get_text()
-		if name != "":
-			query += ' "name" LIKE ? AND'
-			args.append("%" + _replace_chars(name) + "%")
-		text = self.entry_text.get_text()
-		if text != "":
-			query += ' "text" LIKE ? AND'
-			args.append("%" + _replace_chars(text) + "%")
+		# Construct the filter
+		f = filters.Filter()
+		f.name = _replace_chars(self.entry_name.get_text())
+		f.text = self.entry_text.get_text()
 		cardtypes = self.entry_types.get_text()
 		if cardtypes != "":
-			words = _replace_chars(cardtypes).split("%")
-			for word in words:
-				query += ' ("type" LIKE ? OR "subtype" LIKE ?) AND'
-				args.extend(2 * ["%" + word + "%"])
-		artist = self.entry_artist.get_text()
-		if artist != "":
-			query += ' "artist" LIKE ? AND'
-			args.append("%" + _replace_chars(artist) + "%")
-		flavor = self.entry_flavor.get_text()
-		if flavor != "":
-			query += ' "flavor" LIKE ? AND'
-			args.append("%" + _replace_chars(flavor) + "%")
+			f.types = _replace_chars(cardtypes).split("%")
+		f.artist = _replace_chars(self.entry_artist.get_text())
+		f.flavor = self.entry_flavor.get_text()
 		cardsets = self.entry_sets.get_text()
 		if cardsets != "":
 			cardsets = cardsets.replace(",", "") # remove commas
-			cl = _replace_chars(cardsets).split("%")
-			if cl != []:
-				query += ' ('
-				for cset in cl:
-					query += ' "setname" LIKE ? OR'
-					args.append("%" + cset + "%")
-				query = query[:-2]
-				query += ') AND'
+			f.sets = _replace_chars(cardsets).split("%")
 		rarities = self.entry_rarity.get_text()
 		if rarities != "":
 			rarities = rarities.replace(",", "") # remove commas
-			r = _replace_chars(rarities).split("%")
-			if r != []:
-				query += ' ('
-				for rarity in r:
-					query += ' "rarity" LIKE ? OR'
-					args.append(rarity + "%")
-				query = query[:-2]
-				query += ') AND'
+			f.rarities = _replace_chars(rarities).split("%")
 		
-		exact_color = self.checkbutton_exclude.get_active()
-		clist = ["white", "blue", "black", "red", "green", "colorless"]
-		if any(map(lambda c: getattr(self, "checkbutton_" + c).get_active(),
-				clist)) or self.checkbutton_lands.get_active():
-			if not exact_color:
-				query += '('
-			for c in clist:
-				cb = getattr(self, "checkbutton_" + c).get_active()
-				if cb or exact_color:
-					query += ' "is%s" == ? %s' % (c,
-						'AND' if exact_color else 'OR')
-					args.append(cb)
-			if self.checkbutton_lands.get_active():
-				query += '"type" LIKE "%Land%" '
-				query += 'AND' if exact_color else 'OR'
-			if not exact_color:
-				query = query[:-2] + ') AND'
-		if self.checkbutton_multicolor.get_active():
-			query += ' "iswhite" + "isblue" + "isblack" + "isred" + "isgreen"' \
-				' >= 2 AND'
+		for c in filters.COLORS:
+			if getattr(self, "checkbutton_" + c).get_active():
+				f.colors.add(c)
+		f.lands = self.checkbutton_lands.get_active()
+		f.exact_colors = self.checkbutton_exclude.get_active()
+		f.multicolor = self.checkbutton_multicolor.get_active()
 		
 		eq = ["", "=", "<=", ">="]
 		price_eq = self.combobox_eq_price.get_active()
 		if price_eq > 0:
-			query += ' "price" %s ? AND "price" >= 0 AND' % eq[price_eq]
-			args.append(int(self.spinbutton_price.get_value() * 100))
+			f.price = eq[price_eq], int(self.spinbutton_price.get_value() * 100)
 		converted_eq = self.combobox_eq_converted_cost.get_active()
 		if converted_eq > 0:
-			query += ' "converted" %s ? AND' % eq[converted_eq]
-			args.append(self.spinbutton_converted_cost.get_value_as_int())
+			f.converted = (eq[converted_eq],
+				self.spinbutton_converted_cost.get_value_as_int())
 		power_eq = self.combobox_eq_power.get_active()
 		if power_eq > 0:
-			query += ' CAST("power" AS INTEGER) %s ? AND' % eq[power_eq]
-			args.append(self.spinbutton_power.get_value_as_int())
+			f.power = eq[power_eq], self.spinbutton_power.get_value_as_int()
 		toughness_eq = self.combobox_eq_toughness.get_active()
 		if toughness_eq > 0:
-			query += ' CAST("toughness" AS INTEGER) %s ? AND' % eq[toughness_eq]
-			args.append(self.spinbutton_toughness.get_value_as_int())
+			f.toughness = (eq[toughness_eq],
+				self.spinbutton_toughness.get_value_as_int())
 		mana_eq = self.combobox_eq_manacost.get_active()
 		manacost = self.entry_manacost.get_text()
 		if mana_eq == 1 and manacost != "":
-			query += ' "manacost" == ? AND'
-			args.append(manacost)
+			f.manacost = manacost
 		if mana_eq == 2 and manacost != "":
-			total = 0
-			mana_cl = manacost
-			for c in "WUBRGXYZP":
-				query += ' "manacost" LIKE ? AND'
-				args.append("%" + manacost.count(c) * c + "%")
-				if c not in "XYZP":
-					total += manacost.count(c)
-				mana_cl = mana_cl.replace(c, "")
-			try:
-				i = int(mana_cl)
-			except:
-				pass
-			else:
-				query += ' "converted" >= ? AND'
-				args.append(total + i)
+			f.contains_mana = manacost
 		
-		# Execute query
-		if self._execute_search(query[:-3], args) != []:
+		if f.is_empty():
+			return # Don't execute an empty query
+		
+		self._start_search(self._run_extended_search(f))
+	
+	def _run_extended_search(self, cardfilter):
+		"""Run the extended search in a worker thread and show its results"""
+		try:
+			l = yield async.threaded(filters.search, cardfilter)
+		except sqlite3.OperationalError as e:
+			self._search_task = None
+			self.show_dialog(self.main_win, "SQL error:\n" + str(e), "error")
+			return
+		self._search_task = None
+		self._show_results(l)
+		if l != []:
 			self.label_no_results.hide()
 		else:
 			self.label_no_results.show()
@@ -1232,34 +1198,40 @@ class Interface(uiloader.Interface):
 			# FIXME: another search might get executed in the mean time
 	
 	def execute_custom_search(self, widget):
-		"""Execute the custom search"""
+		"""Execute the custom search in a worker thread and profile it"""
 		bfr = self.textview_sqlquery.get_buffer()
 		query = bfr.get_text(bfr.get_start_iter(), bfr.get_end_iter())
-		self._execute_search(query)
+		if not self._check_query(query):
+			return
+		self._cancel_search()
+		self._search = cards.Search(query)
+		self._search_task = async.start(self._run_search(self._search))
 	
 	def search_lands(self, widget):
 		"""Find lands matching a deck's colors"""
 		if self.deck is None:
 			return
-		query = '"type" LIKE "%Land%" AND '
-		mana = {"white":"W", "blue":"U", "black":"B", "red":"R", "green":"G"}
 		basic = {"white":"Plains", "blue":"Island", "black":"Swamp",
 			"red":"Mountain", "green":"Forest"}
+		mask = cards.color_mask(self.deck.color)
+		query = '"type" LIKE ?'
+		args = ["%Land%"]
 		if len(self.deck.color) >= 1:
-			query += '('
-		for c in self.deck.color:
-			query += '"text" LIKE "%%{%s}%%" OR ' % mana[c]
-			query += '"text" LIKE "%%%s%%" OR ' % basic[c]
-		query = query[:-4]
-		if len(self.deck.color) >= 1:
+			# Lands producing or fetching one of the deck's colors
+			query += ' AND ("identity" & ? != 0'
+			args.append(mask)
+			for c in self.deck.color:
+				query += ' OR "text" LIKE ?'
+				args.append("%" + basic[c] + "%")
 			query += ')'
-		query += ' AND '
+		# but none of the other colors
+		query += ' AND "identity" & ? = 0'
+		args.append(cards.ALL_COLORS & ~mask)
 		for c in ["white", "blue", "black", "red", "green"]:
 			if c not in self.deck.color:
-				query += 'NOT "text" LIKE "%%{%s}%%" AND ' % mana[c]
-				query += 'NOT "text" LIKE "%%%s%%" AND ' % basic[c]
-		query = query[:-5]
-		self._execute_search(query)
+				query += ' AND NOT "text" LIKE ?'
+				args.append("%" + basic[c] + "%")
+		self._execute_search(query, args)
 	
 	def view_new_cards_show_query(self, widget):
 		self.win_set_query.show()
@@ -1271,44 +1243,89 @@ class Interface(uiloader.Interface):
 	# Database access
 	#
 	
-	def _execute_search(self, query, args=()):
+	def _check_query(self, query):
+		"""Check if a query can be executed"""
 		if query == "":
-			return # Don't execute an empty query
+			return False # Don't execute an empty query
 		# Protect against SQL injection
 		if query.find(";") >= 0:
 			self.show_dialog(self.main_win,
 				_("The query must not contain ';'."), "error")
+			return False
+		return True
+	
+	def _execute_search(self, query, args=()):
+		"""Execute a search in a worker thread"""
+		if not self._check_query(query):
+			return
+		self._start_search(self._run_query(query, tuple(args)))
+	
+	def _run_query(self, query, args):
+		"""Run a search query in a worker thread and show its results"""
+		try:
+			l = yield async.threaded(cards.search, query, args)
+		except sqlite3.OperationalError as e:
+			self._search_task = None
+			self.show_dialog(self.main_win, "SQL error:\n" + str(e), "error")
 			return
+		self._search_task = None
+		self._show_results(l)
+	
+	def _run_search(self, search):
+		"""Run a custom search in a worker thread and show its results"""
 		try:
-			l = cards.search(query, args)
+			l, profile = yield async.threaded(search.run)
+		except cards.SearchCanceled as e:
+			if search is self._search and search.timed_out:
+				self._search = self._search_task = None
+				self.show_dialog(self.main_win, str(e), "error")
+			return
 		except sqlite3.OperationalError as e:
-			message = "SQL error:\n" + str(e)
-			self.show_dialog(self.main_win, message, "error")
-		else:
-			self._show_results(l)
-			return l
+			if search is self._search:
+				self._search = self._search_task = None
+				message = "SQL error:\n" + str(e)
+				self.show_dialog(self.main_win, message, "error")
+			return
+		if search is not self._search:
+			return # another search has been started in the mean time
+		self._search = self._search_task = None
+		self.label_query_profile.set_text(str(profile))
+		self._show_results(l)
+	
+	def _start_search(self, task):
+		"""Replace the running search by a new search task"""
+		self._cancel_search()
+		self._search_task = async.start(task)
+	
+	def _cancel_search(self):
+		"""Stop the running search; its results will not be shown"""
+		if self._search is not None:
+			self._search.cancel()
+			self._search = None
+		if self._search_task is not None:
+			self._search_task.cancel()
+			self._search_task = None
 	
 	def _show_results(self, cardlist):
+		self._cancel_search() # would replace these results
+		self._results = cardlist
+		
+		# Group cards with the same name
+		groups = collections.OrderedDict()
+		for card in cardlist:
+			groups.setdefault(card.name, []).append(card)
+		minprices = cards.get_min_prices(name for name, versions in
+			groups.iteritems() if len(versions) > 1)
+		
 		# Insert results into the TreeStore
 		self.results.clear()
-		i = -1
-		while i + 1 < len(cardlist):
-			i += 1
-			# Group cards with the same name
-			versions = filter(lambda c: c.name == cardlist[i].name, cardlist)
-			if versions.index(cardlist[i]) > 0:
-				# This card has been handled
-				continue
+		for name, versions in groups.iteritems():
 			if len(versions) <= 1:
 				it = None
 			else:
 				# Insert a parent card
 				card = max(versions, key=lambda card: card.releasedate)
-				versions_ = filter(lambda card: card.price >= 0, versions)
-				if len(versions_) == 0:
-					minprice = -1
-				else:
-					minprice = min(versions_, key=lambda card: card.price).price
+				minprice = minprices.get(name, -1)
 				it = self.results.append(None, (card.id, card.name,
 					card.manacost, card.get_composed_type(), card.power,
 					card.toughness, card.rarity[0], "...", minprice,
@@ -1325,9 +1342,9 @@ class Interface(uiloader.Interface):
 			text = _("no results")
 		elif len(cardlist) == 1:
 			text = _("one result")
-		elif len(cardlist) >= settings.results_limit:
+		elif not getattr(cardlist, "complete", True):
 			text = _("at least %d results") % len(cardlist)
-#			self.button_more_results.show() # FIXME
+			self.button_more_results.show()
 		else:
 			text = _("%d results") % len(cardlist)
 		self.label_results.set_text(text)
@@ -1340,7 +1357,7 @@ class Interface(uiloader.Interface):
 			# If there is only one card result, expand the versions
 			if self.results.iter_next(it) is None:
 				self.resultview.expand_all()
-		if len(cardlist) < settings.results_limit:
+		if getattr(cardlist, "complete", True):
 			self.button_more_results.hide()
 
 
@@ -1354,6 +1371,24 @@ def _price_to_text(price):
 		return _("$%.2f") % (float(price) / 100)
 
 
+def _quicksearch(text):
+	"""Search the cards for the quicksearch text, trying the columns one after
+	another until there are results"""
+	query = text
+	i = 0
+	for q in ['"id" == ?', '"manacost" == ?',
+			'"name" LIKE ? OR "type" LIKE ? OR "subtype" LIKE ?',
+			'"setname" LIKE ?', '"artist" LIKE ?']:
+		l = cards.search(q, (query,) * q.count("?"))
+		if l != []:
+			return l
+		i += 1
+		if i >= 2:
+			query = "%" + _replace_chars(text) + "%"
+	# Search the rules text using the full-text index
+	return cards.fulltext_search(text, "text")
+
+
 def _replace_chars(s):
 	"""Replace every space not enclosed in quotes by %"""
 	t = s.split("\"")
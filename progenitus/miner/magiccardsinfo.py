@@ -101,12 +101,13 @@ def mine_set(setcode, releasedate, magiccardsinfocode):
 		t = cardtype.split(" - ")
 		card.cardtype = t[0].strip()
 		card.subtype = "" if len(t) <= 1 else t[1].strip()
-		card.converted_cost = cards.convert_mana(card.manacost)
+		card.derive_mana()
 		card.setid = setcode
 		card.setname = setname.strip()
 		card.releasedate = releasedate.toordinal()
 		card.derive_id()
 		card.derive_colors()
+		card.derive_stats()
 		cardlist.append(card)
 	return setname.strip(), cardlist
 
@@ -115,6 +116,10 @@ def mine_tokens():
 	"""Mine all tokens"""
 	html = miner.download(con, url_tokens)
 	tokens = []
+	c = cards.get_connection().cursor()
+	c.execute('SELECT "name", "id", "releasedate" FROM "sets"')
+	sets = dict((name, (setid, releasedate)) for name, setid, releasedate
+		in c)
 	for part in html.split('</table>'):
 		setname_match = re_token.search(part)
 		if setname_match is None:
@@ -122,15 +127,11 @@ def mine_tokens():
 		setname = setname_match.group(1)
 		
 		# Get the set id
-		cards._cursor.execute('SELECT * FROM "sets" WHERE "name" = ?',
-			(setname,))
-		row = cards._cursor.fetchone()
-		if row is None:
+		if setname not in sets:
 			continue
 #			raise RuntimeError(_("Set not found in the database: '%s'.")
 #				% setname)
-		setid = row[0]
-		releasedate = row[3]
+		setid, releasedate = sets[setname]
 		
 		tokens_ = re_token2.findall(part)
 		if tokens_ is None:
@@ -27,7 +27,6 @@ def mine_pricelist(setname):
 		if match is None:
 			continue
 		cardname = unicode(match.group(1), errors="ignore")
-		cardname = cardname.replace(u'AE', u'\xc3')
 		prices = re_price.findall(part)
 		if prices is None or len(prices) < 3:
 			continue
@@ -33,12 +33,26 @@ _settings = [
 	("DEFAULT", "save_ram", "bool", False,
 		"The program should reduce memory footprint even at the cost of speed "
 		"or features"),
+	("DEFAULT", "query_cache_size", "int", 8192,
+		"Memory budget of the card search result cache (KB)"),
+	("DEFAULT", "picture_cache_size", "int", 65536,
+		"Memory budget of the card picture cache (KB)"),
+	("DEFAULT", "packed_pictures", "bool", False,
+		"Store the card pictures of every set in a single archive file"),
+	("DEFAULT", "surface_cache_size", "int", 32768,
+		"Memory budget of the scaled card pictures of every card table (KB)"),
+	("DEFAULT", "db_in_memory", "bool", False,
+		"Copy the card database into memory for faster searches at the cost of "
+		"memory"),
 	("Updater", "disclaimer_agreed", "bool", False,
 		"The user has agreed to the disclaimer"),
 	("Updater", "list_url", "str",
 		"https://raw.github.com/TheGurke/Progenitus/master/downloadlist.txt",
 		"URL to the set download list"),
 	("Editor", "results_limit", "int", 500, "Maximum number of search results"),
+	("Editor", "query_timeout", "int", 5000,
+		"Custom searches are aborted after this time (milliseconds, 0 for no "
+		"limit)"),
 	("Editor", "decksave_timeout", "int", 5000,
 		"The deck is saved automatically in this interval (milliseconds)"),
 	("Client", "username", "str", "", "Jabber login username"),
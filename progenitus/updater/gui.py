@@ -6,7 +6,6 @@ import datetime
 
 from gettext import gettext as _
 import logging
-import sqlite3
 import glib
 import gtk
 
@@ -102,7 +101,7 @@ class Interface(uiloader.Interface):
 			cards.create_db(db_file)
 		
 		cards.connect()
-		self.sqlconn = sqlite3.connect(db_file)
+		self.sqlconn = cards.writer()
 		self.cursor = self.sqlconn.cursor()
 		
 		# Create directories
@@ -152,8 +151,8 @@ class Interface(uiloader.Interface):
 					(setcode, setname, len(cardlist), releasedate.toordinal()))
 				for i in range(len(cardlist)):
 					self.progressbar2.set_fraction(float(i) / len(cardlist))
-					self.cursor.execute(u'INSERT INTO "cards" VALUES (' +
-						23 * '?,' + '?)', cardlist[i].as_tuple())
+					cards.insert_card(self.cursor, cardlist[i])
+				cards.increment_generation(self.sqlconn)
 				self.sqlconn.commit()
 			assert(cardlist is not None)
 			
@@ -165,13 +164,18 @@ class Interface(uiloader.Interface):
 				if pricelist == []:
 					logging.warning(_("No pricing information for '%s'."),
 						setname)
+				# tcgplayer writes names differently, e.g. "AEther Vial"
+				index = names.NameIndex(card.name for card in cardlist)
 				for i in range(len(pricelist)):
 					name, price = pricelist[i]
 					self.progressbar2.set_fraction(float(i) / len(pricelist))
-					self.cursor.execute('UPDATE "cards" SET "price" = ? '
-						'WHERE "name" = ? AND "setname" = ?',
-						(price, name, setname)
-					)
+					for cardname in index.lookup(name):
+						self.cursor.execute('UPDATE "cards" SET "price" = ? '
+							'WHERE "name" = ? AND "setname" = ?',
+							(price, cardname, setname)
+						)
+				cards.update_prices(self.cursor)
+				cards.increment_generation(self.sqlconn)
 				self.sqlconn.commit()
 			
 			# Download card pictures
@@ -188,9 +192,12 @@ class Interface(uiloader.Interface):
 					self.progressbar2.set_fraction(float(i) / len(cardlist))
 					card = cardlist[i]
 					pic_filename = pics._get_path(card.id)
-					if not os.path.exists(pic_filename):
+					if not pics.exists(card.id):
 						yield magiccardsinfo.mine_pic(magiccardsinfo.url_pic
 							% (mcinfosetcode, card.collectorsid), pic_filename)
+					yield async.threaded(pics.make_thumbnails, card.id)
+				if settings.packed_pictures:
+					yield async.threaded(packs.pack_set, setcode)
 		
 		# Download tokens
 		if self.checkbutton_download_tokens.get_active():
@@ -211,8 +218,9 @@ class Interface(uiloader.Interface):
 				
 				# Get token picture
 				pic_filename = pics._get_path(token.id)
-				if not os.path.exists(pic_filename):
+				if not pics.exists(token.id):
 					yield magiccardsinfo.mine_pic(pic_url, pic_filename)
+				yield async.threaded(pics.make_thumbnails, token.id)
 				
 				# Insert database entry
 				try:
@@ -220,6 +228,7 @@ class Interface(uiloader.Interface):
 				except RuntimeError:
 					self.cursor.execute(u'INSERT INTO "tokens" VALUES (' +
 						17 * '?,' + '?)', token.as_tuple())
+					cards.increment_generation(self.sqlconn)
 					self.sqlconn.commit()
 		
 		glib.idle_add(self.download_complete)